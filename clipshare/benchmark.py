@@ -0,0 +1,363 @@
+"""Headless benchmarks for the chunking and relay pipeline.
+
+Everything runs in this one process: an in-memory clipboard stands in for the
+real one, and clients talk to a server over loopback websockets, so no display
+is needed. Each benchmark is swept over payload sizes, chunk sizes and peer
+counts, and reports throughput, p50/p99 latency and peak memory.
+
+    python -m clipshare.benchmark [--quick] [--only roundtrip,fanout]
+                                  [--output results.json]
+                                  [--baseline baseline.json]
+
+With --baseline, anything that got slower than the baseline by more than
+--tolerance is reported as a regression, and the exit status is 1.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import socket
+import sys
+import time
+import tracemalloc
+
+from async_generator import asynccontextmanager
+from asyncblink import AsyncSignal
+import websockets
+
+from .chunked_receiving import ChunkedMessageReceiver
+from .chunked_sending import Message
+from .chunked_sending import Splitter
+from . import client_relay_node
+from .client_relay_node import ClientRelayNode
+from .frames import SUBPROTOCOLS
+from . import log
+from . import payload_cache
+from .relay import Relay
+from .remote_relay_node import RemoteRelayNode
+from .rooms import Rooms
+from .server import Server
+from . import signals
+from . import throughput
+from .websocket import COMPRESSION
+from .websocket import MAX_PAYLOAD_SIZE
+
+
+PAYLOAD_SIZES = [10_000, 1_000_000, 10_000_000, 50_000_000]
+CHUNK_SIZES = [16_000, 100_000, 1_000_000]
+PEER_COUNTS = [1, 4, 16]
+QUICK_PAYLOAD_SIZES = [10_000, 1_000_000]
+QUICK_CHUNK_SIZES = [16_000, 100_000]
+QUICK_PEER_COUNTS = [1, 4]
+# round trips also get run with chunk sizes picked per connection, the way
+# they normally are
+ADAPTIVE = 'adaptive'
+
+# the peer sweep of the round trip benchmark is done at one payload size
+PEER_SWEEP_PAYLOAD_SIZE = 1_000_000
+
+REPETITIONS = 10
+# big payloads get fewer repetitions, so the whole thing doesn't take forever
+MAX_BYTES_PER_CASE = 200_000_000
+MIN_REPETITIONS = 3
+
+DEFAULT_TOLERANCE = 0.2
+
+
+class FakeClipboard:
+
+    def __init__(self):
+        self.new_clipboard_contents_signal = AsyncSignal()
+        self.was_set = asyncio.Event()
+
+    def set(self, clipboard_contents, *, trace_id=None):
+        self.was_set.set()
+
+    def clear(self):
+        pass
+
+    def start_listening_for_changes(self):
+        pass
+
+    def copy(self, clipboard_contents):
+        self.new_clipboard_contents_signal.send(clipboard_contents)
+
+
+# a node on the receiving end of the relay, that just takes all the chunks
+class SinkNode:
+
+    def __init__(self):
+        self.new_message_signal = AsyncSignal()
+        self.origins = set()
+        self.received = asyncio.Event()
+
+    async def accept_relayed_message(self, message):
+        async for _ in message.chunks:
+            pass
+        self.received.set()
+
+    def start_relaying_changes(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+# each benchmark sets up a case with the given parameters, and hands over an
+# async function that runs it once
+@asynccontextmanager
+async def splitter(*, payload_size, chunk_size):
+    payload = _make_payload(payload_size)
+
+    async def run():
+        message = Message(payload=payload, split_size=chunk_size)
+        async for _ in message.chunks:
+            pass
+    yield run
+
+
+@asynccontextmanager
+async def receiver(*, payload_size, chunk_size):
+    serialized = Message(payload=_make_payload(payload_size),
+                         split_size=chunk_size)._serialized
+    chunks = list(Splitter.split(serialized, split_size=chunk_size))
+
+    async def chunk_generator():
+        for chunk in chunks:
+            yield chunk
+
+    async def run():
+        message_receiver = ChunkedMessageReceiver(chunk_generator())
+        async for message in message_receiver.received_messages:
+            await message.full_payload
+    yield run
+
+
+@asynccontextmanager
+async def fanout(*, payload_size, peers):
+    payload = _make_payload(payload_size)
+    relay = Relay()
+    source = SinkNode()
+    sinks = [SinkNode() for _ in range(peers)]
+
+    async def run():
+        for sink in sinks:
+            sink.received.clear()
+        source.new_message_signal.send(Message(
+            payload=payload, split_size=client_relay_node.BYTES_PER_SPLIT))
+        await asyncio.gather(*(sink.received.wait() for sink in sinks))
+
+    with contextlib.ExitStack() as node_contexts:
+        for node in [source] + sinks:
+            node_contexts.enter_context(relay.with_node(node))
+        yield run
+
+
+# client -> server -> client(s), over websockets on loopback, from something
+# being copied until the clipboard gets set on every other client
+@asynccontextmanager
+async def roundtrip(*, payload_size, chunk_size, peers):
+    payload = _make_payload(payload_size)
+    split_size_bounds = throughput.MIN_SPLIT_SIZE, throughput.MAX_SPLIT_SIZE
+    if chunk_size != ADAPTIVE:
+        throughput.MIN_SPLIT_SIZE = throughput.MAX_SPLIT_SIZE = chunk_size
+    server, port = await _start_server()
+    websockets_to_close = []
+    try:
+        with contextlib.ExitStack() as node_contexts:
+            clipboards = []
+            for _ in range(peers + 1):
+                clipboard = FakeClipboard()
+                websocket = await websockets.connect(
+                    f'ws://127.0.0.1:{port}', max_size=MAX_PAYLOAD_SIZE,
+                    compression=COMPRESSION, subprotocols=SUBPROTOCOLS)
+                websockets_to_close.append(websocket)
+                relay = Relay()
+                node_contexts.enter_context(
+                    relay.with_node(ClientRelayNode(clipboard)))
+                node_contexts.enter_context(
+                    relay.with_node(RemoteRelayNode(websocket)))
+                clipboards.append(clipboard)
+            sender, *receivers = clipboards
+
+            async def run():
+                for clipboard in receivers:
+                    clipboard.was_set.clear()
+                sender.copy(payload)
+                await asyncio.gather(*(clipboard.was_set.wait()
+                                       for clipboard in receivers))
+            yield run
+    finally:
+        for websocket in websockets_to_close:
+            await websocket.close()
+        server.stop()
+        throughput.MIN_SPLIT_SIZE, throughput.MAX_SPLIT_SIZE = split_size_bounds
+
+
+async def _start_server():
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        port = free_socket.getsockname()[1]
+    listening = asyncio.Event()
+    def on_listening(sender):
+        listening.set()
+    signals.server_listening.connect(on_listening)
+    server = Server('127.0.0.1', port, Rooms(Relay))
+    server.start()
+    await listening.wait()
+    signals.server_listening.disconnect(on_listening)
+    return server, port
+
+
+def _make_payload(size):
+    # random, so compression doesn't make big payloads look faster than they
+    # are
+    return {'image/png': os.urandom(size)}
+
+
+BENCHMARKS = {'splitter': splitter, 'receiver': receiver, 'fanout': fanout,
+              'roundtrip': roundtrip}
+
+
+def cases(*, quick):
+    payload_sizes = QUICK_PAYLOAD_SIZES if quick else PAYLOAD_SIZES
+    chunk_sizes = QUICK_CHUNK_SIZES if quick else CHUNK_SIZES
+    peer_counts = QUICK_PEER_COUNTS if quick else PEER_COUNTS
+    for name in ('splitter', 'receiver'):
+        for payload_size in payload_sizes:
+            for chunk_size in chunk_sizes:
+                yield name, {'payload_size': payload_size,
+                             'chunk_size': chunk_size}
+    for payload_size in payload_sizes:
+        for peers in peer_counts:
+            yield 'fanout', {'payload_size': payload_size, 'peers': peers}
+    for payload_size in payload_sizes:
+        for chunk_size in chunk_sizes + [ADAPTIVE]:
+            yield 'roundtrip', {'payload_size': payload_size,
+                                'chunk_size': chunk_size, 'peers': 1}
+    for peers in peer_counts:
+        if peers != 1:
+            yield 'roundtrip', {'payload_size': PEER_SWEEP_PAYLOAD_SIZE,
+                                'chunk_size': ADAPTIVE, 'peers': peers}
+
+
+def case_key(name, params):
+    return ' '.join([name] + [f'{key}={value}'
+                              for key, value in sorted(params.items())])
+
+
+async def run_case(name, params, *, repetitions):
+    repetitions = max(MIN_REPETITIONS, min(
+        repetitions, MAX_BYTES_PER_CASE // params['payload_size']))
+    async with BENCHMARKS[name](**params) as run:
+        # warm up, and measure peak memory on the side. tracing every
+        # allocation slows things down a lot, so the timed runs go without it
+        tracemalloc.start()
+        await run()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        seconds = []
+        for _ in range(repetitions):
+            started_at = time.perf_counter()
+            await run()
+            seconds.append(time.perf_counter() - started_at)
+    seconds.sort()
+    mean = sum(seconds) / len(seconds)
+    return {'repetitions': repetitions,
+            'mean_seconds': mean,
+            'p50_seconds': _percentile(seconds, 0.5),
+            'p99_seconds': _percentile(seconds, 0.99),
+            'bytes_per_second': params['payload_size'] / mean,
+            'peak_memory_bytes': peak_memory}
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction),
+                             len(sorted_values) - 1)]
+
+
+async def run_all(*, quick, only, repetitions):
+    results = {}
+    for name, params in cases(quick=quick):
+        if only and name not in only:
+            continue
+        key = case_key(name, params)
+        result = await run_case(name, params, repetitions=repetitions)
+        results[key] = result
+        print(f'{key:<60} {result["bytes_per_second"] / 1e6:>9.1f}MB/s '
+              f'p50 {result["p50_seconds"] * 1000:>8.1f}ms '
+              f'p99 {result["p99_seconds"] * 1000:>8.1f}ms '
+              f'peak {result["peak_memory_bytes"] / 1e6:>7.1f}MB', flush=True)
+    return results
+
+
+# a case regressed if its throughput dropped, or its median latency went up,
+# by more than the tolerance. returns (key, what regressed, baseline, now)
+def find_regressions(results, baseline_results, *, tolerance):
+    regressions = []
+    for key, result in results.items():
+        baseline = baseline_results.get(key)
+        if not baseline:
+            continue
+        if result['bytes_per_second'] < (
+                baseline['bytes_per_second'] * (1 - tolerance)):
+            regressions.append((key, 'bytes_per_second',
+                                baseline['bytes_per_second'],
+                                result['bytes_per_second']))
+        if result['p50_seconds'] > baseline['p50_seconds'] * (1 + tolerance):
+            regressions.append((key, 'p50_seconds', baseline['p50_seconds'],
+                                result['p50_seconds']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--quick', action='store_true',
+                        help='sweep fewer, smaller cases')
+    parser.add_argument('--only', default='',
+                        help='comma separated benchmarks to run, out of '
+                             + ', '.join(BENCHMARKS))
+    parser.add_argument('--repetitions', type=int, default=REPETITIONS)
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--baseline',
+                        help='compare against results saved with --output')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='how much slower than the baseline is still ok, '
+                             'as a fraction')
+    args = parser.parse_args()
+
+    # debug logging for every chunk would be the main thing being measured
+    if 'CLIPSHARE_LOG_LEVEL' not in os.environ:
+        log.configure(level='warning')
+    # every node in here shares the one payload cache. left on, the server
+    # would already have everything a client sends it
+    payload_cache.cache.max_bytes = 0
+
+    only = {name for name in args.only.split(',') if name}
+    results = asyncio.get_event_loop().run_until_complete(run_all(
+        quick=args.quick, only=only, repetitions=args.repetitions))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'python': sys.version, 'platform': platform.platform(),
+                       'created_at': time.time(), 'results': results},
+                      file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline_results = json.load(file)['results']
+        regressions = find_regressions(results, baseline_results,
+                                       tolerance=args.tolerance)
+        for key, metric, baseline, now in regressions:
+            print(f'REGRESSION {key}: {metric} {baseline:.4g} -> {now:.4g}')
+        if regressions:
+            sys.exit(1)
+        print(f'no regressions against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+import asyncio
+import os
+import struct
+
+from asyncblink import AsyncSignal
+
+from .chunked_receiving import Rejoiner
+from .chunked_receiving import without_delta
+from .frames import FrameCodec
+from . import log
+
+
+logger = log.getLogger(__name__)
+
+
+# when the server runs as several worker processes, the devices in a room can
+# end up connected to different workers. the bus carries messages between the
+# workers over unix domain sockets, so everybody in a room still gets
+# everything.
+#
+# every worker listens on its own socket, and opens a connection to every
+# other worker's. a worker only ever writes to the connections it opened, and
+# only ever reads from the ones it accepted. everything that goes over a
+# connection is a record:
+#
+#   kind (1 byte), room length (2 bytes), body length (4 bytes), room, body
+#
+# JOIN and LEAVE say that the sending worker now has, or no longer has, anybody
+# in the room, and have no body. a worker only sends a room's messages to the
+# workers that have somebody in it. FRAME carries one chunk of a message, as a
+# frame in the frame format (see frames.py), so chunks that came in as frames
+# go over the bus without being re-encoded. HELLO is the first record on every
+# connection, and its body is the index of the worker that opened it
+RECORD_HEADER = struct.Struct('!BHI')
+HELLO = 0
+JOIN = 1
+LEAVE = 2
+FRAME = 3
+
+CONNECT_RETRY_SECONDS = 0.1
+CONNECT_TIMEOUT_SECONDS = 10
+
+
+def socket_path(socket_dir, worker_index):
+    return os.path.join(socket_dir, f'worker-{worker_index}.sock')
+
+
+class Bus:
+
+    def __init__(self, socket_dir, worker_index, num_workers):
+        self._socket_dir = socket_dir
+        self._worker_index = worker_index
+        self._num_workers = num_workers
+        self._codec = FrameCodec()
+        self._server = None
+        # worker index -> connection we write to
+        self._peers = {}
+        # worker index -> the rooms it has anybody in
+        self._rooms_by_worker = {}
+        # room -> the node for it, while anybody here is in it
+        self._nodes_by_room = {}
+
+    async def start(self):
+        self._server = await asyncio.start_unix_server(
+            self._handle_peer,
+            socket_path(self._socket_dir, self._worker_index))
+        await asyncio.gather(*(
+            self._connect_to(worker_index)
+            for worker_index in range(self._num_workers)
+            if worker_index != self._worker_index))
+        logger.info('worker %d connected to the bus', self._worker_index)
+
+    async def _connect_to(self, worker_index):
+        path = socket_path(self._socket_dir, worker_index)
+        deadline = asyncio.get_event_loop().time() + CONNECT_TIMEOUT_SECONDS
+        # the other workers are starting up at the same time as this one
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if asyncio.get_event_loop().time() > deadline:
+                    raise
+                await asyncio.sleep(CONNECT_RETRY_SECONDS)
+        peer = self._peers[worker_index] = _Peer(writer)
+        await peer.send(HELLO, '', str(self._worker_index).encode())
+        # in case somebody's joined a room here already
+        for room in self._nodes_by_room:
+            await peer.send(JOIN, room)
+
+    # the node that stands in for every other worker in a room. it's added to
+    # the room's relay for as long as the room is open on this worker
+    def node_for(self, room):
+        return BusNode(self, room)
+
+    def _open_room(self, node):
+        self._nodes_by_room[node.room] = node
+        self._send_to_all_peers(JOIN, node.room)
+
+    def _close_room(self, node):
+        if self._nodes_by_room.get(node.room) is node:
+            del self._nodes_by_room[node.room]
+            self._send_to_all_peers(LEAVE, node.room)
+
+    def _send_to_all_peers(self, kind, room):
+        for peer in self._peers.values():
+            asyncio.ensure_future(peer.send(kind, room))
+
+    async def _send_message(self, room, message):
+        metadata = message.metadata
+        async for chunk in message.chunks:
+            peers = [peer for worker_index, peer in self._peers.items()
+                     if room in self._rooms_by_worker.get(worker_index, ())]
+            if not peers:
+                # nobody on any other worker is in the room
+                return
+            frame = self._codec.encode(
+                chunk, metadata if chunk.is_the_first_chunk else None)
+            await asyncio.gather(*(peer.send(FRAME, room, frame)
+                                   for peer in peers))
+
+    async def _handle_peer(self, reader, writer):
+        # chunks from the other worker get rejoined separately for each room,
+        # so messages with the same hash in different rooms don't get mixed up
+        rejoiners_by_room = {}
+        try:
+            kind, _, body = await _read_record(reader)
+            if kind != HELLO:
+                raise ValueError(f'expected a hello from a worker, got {kind}')
+            rooms = self._rooms_by_worker[int(body)] = set()
+            while True:
+                kind, room, body = await _read_record(reader)
+                if kind == JOIN:
+                    rooms.add(room)
+                elif kind == LEAVE:
+                    rooms.discard(room)
+                    rejoiners_by_room.pop(room, None)
+                elif kind == FRAME:
+                    self._receive_frame(room, rejoiners_by_room, body)
+        except asyncio.IncompleteReadError:
+            logger.info('a worker disconnected from the bus')
+        finally:
+            writer.close()
+
+    def _receive_frame(self, room, rejoiners_by_room, frame):
+        node = self._nodes_by_room.get(room)
+        if not node:
+            # everybody here left the room while the message was on its way
+            rejoiners_by_room.pop(room, None)
+            return
+        rejoiner = rejoiners_by_room.setdefault(room, Rejoiner())
+        new_message = rejoiner.process_incoming_chunk(
+            self._codec.decode(frame))
+        if new_message:
+            node.receive(new_message)
+
+
+class BusNode:
+
+    def __init__(self, bus, room):
+        self.new_message_signal = AsyncSignal()
+        self.room = room
+        # every origin we've seen a message from on another worker, so the
+        # relay knows to send messages meant for them over the bus
+        self.origins = set()
+        self._bus = bus
+
+    # deltas are against content in this worker's payload cache, which the
+    # other workers don't have
+    async def accept_relayed_message(self, message):
+        full_message = await without_delta(message)
+        if not full_message:
+            logger.debug("couldn't rebuild %r to send over the bus", message)
+            return
+        await self._bus._send_message(self.room, full_message)
+
+    def receive(self, message):
+        if message.metadata.get('origin'):
+            self.origins.add(message.metadata['origin'])
+        self.new_message_signal.send(message)
+
+    def start_relaying_changes(self):
+        self._bus._open_room(self)
+
+    # the relay only disconnects nodes that can't keep up. the other workers
+    # are all on the same machine, so just wait for them
+    def disconnect(self):
+        pass
+
+    def close(self):
+        self._bus._close_room(self)
+
+    def __repr__(self):
+        return f'<{type(self).__name__}: {self.room!r}>'
+
+
+# the connection to another worker, that we write to. records are written
+# whole, one at a time, so they don't get interleaved
+class _Peer:
+
+    def __init__(self, writer):
+        self._writer = writer
+        self._lock = asyncio.Lock()
+
+    async def send(self, kind, room, body=b''):
+        encoded_room = room.encode()
+        # a frame is either bytes, or a list of them
+        parts = body if isinstance(body, list) else [body]
+        async with self._lock:
+            self._writer.writelines([
+                RECORD_HEADER.pack(kind, len(encoded_room),
+                                   sum(map(len, parts))),
+                encoded_room, *parts])
+            await self._writer.drain()
+
+
+async def _read_record(reader):
+    kind, room_length, body_length = RECORD_HEADER.unpack(
+        await reader.readexactly(RECORD_HEADER.size))
+    room = (await reader.readexactly(room_length)).decode()
+    body = await reader.readexactly(body_length)
+    return kind, room, body
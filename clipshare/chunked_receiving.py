@@ -1,12 +1,25 @@
 import asyncio
 import pickle
 
+from .chunked_sending import Chunk
+from .chunked_sending import Message
+from .chunked_sending import MessageCancelledError
+from .compression import COMPRESSION_BY_NAME
+from .delta import MissingBaseError
+from .delta import apply_delta
+from . import memory
+from . import metrics
+from . import payload_cache
+from . import tracing
+
 
 class ChunkedMessageReceiver:
 
-    def __init__(self, async_chunk_generator):
+    # cache is the payload cache deltas are rebuilt against (see
+    # payload_cache.py). the default room's, if not given
+    def __init__(self, async_chunk_generator, *, cache=None):
         self._async_chunk_generator = async_chunk_generator
-        self._rejoiner = Rejoiner()
+        self._rejoiner = Rejoiner(cache=cache)
         self._queue = asyncio.Queue()
 
     @property
@@ -15,13 +28,21 @@ class ChunkedMessageReceiver:
         message = await self._queue.get()
         while message is not StopIteration:
             yield message
+            # don't hang onto the last message while waiting for the next
+            # one. its buffer could be huge
+            del message
             message = await self._queue.get()
 
     async def _process_messages(self):
-        async for chunk in self._async_chunk_generator:
-            new_message = self._rejoiner.process_incoming_chunk(chunk)
-            if new_message:
-                await self._queue.put(new_message)
+        try:
+            async for chunk in self._async_chunk_generator:
+                new_message = self._rejoiner.process_incoming_chunk(chunk)
+                if new_message:
+                    await self._queue.put(new_message)
+        finally:
+            # whatever was still coming in when the connection dropped never
+            # will now
+            self._rejoiner.forget_unfinished_messages()
         # XXX: in production, we should never actually finish iterating the
         # socket, because it's an endless stream of messages. but we're testing
         # with a finite generator, so let's halt iteration when that happens
@@ -30,13 +51,24 @@ class ChunkedMessageReceiver:
 
 class Rejoiner:
 
-    def __init__(self):
+    def __init__(self, *, cache=None):
+        self._cache = cache
         self._messages_by_hash = {}
 
     def process_incoming_chunk(self, chunk):
+        if chunk.is_the_first_chunk:
+            # the same content can be sent again right after it was cancelled
+            self._forget_cancelled_messages()
+
         if chunk.message_hash not in self._messages_by_hash:
+            if not chunk.is_the_first_chunk:
+                # the rest of a message that was cancelled. chunks come in
+                # order, so we can't be seeing the start of a new message
+                return None
             self._messages_by_hash[chunk.message_hash] = \
-                ChunkedMessage(chunk.message_hash, chunk.total_chunks)
+                ChunkedMessage(chunk.message_hash, chunk.total_chunks,
+                               metadata=chunk.metadata, cache=self._cache)
+            metrics.incoming_transfers.inc()
             received_first_chunk_of_new_message = True
         else:
             received_first_chunk_of_new_message = False
@@ -47,41 +79,287 @@ class Rejoiner:
             # don't hang onto chunks forever, drop our reference once we no
             # longer need to process them
             del self._messages_by_hash[chunk.message_hash]
+            metrics.incoming_transfers.dec()
 
         if received_first_chunk_of_new_message:
             return chunked_message
 
+    def forget_unfinished_messages(self):
+        metrics.incoming_transfers.dec(len(self._messages_by_hash))
+        self._messages_by_hash = {}
+
+    # the sender stops sending chunks for a cancelled message, so we might
+    # never hear about it again
+    def _forget_cancelled_messages(self):
+        num_messages = len(self._messages_by_hash)
+        self._messages_by_hash = {
+            hash: chunked_message for hash, chunked_message
+            in self._messages_by_hash.items()
+            if not chunked_message.is_cancelled}
+        metrics.incoming_transfers.dec(
+            num_messages - len(self._messages_by_hash))
+
 
 class ChunkedMessage:
 
-    def __init__(self, hash, num_chunks):
+    def __init__(self, hash, num_chunks, *, metadata, cache=None):
         self.hash = hash
         self.num_chunks = num_chunks
+        self.metadata = metadata
+        self._cache = payload_cache.cache if cache is None else cache
+        self.is_cancelled = False
         self._chunk_futures = [asyncio.Future() for _ in range(num_chunks)]
+        self._chunk_size = None
+        self._decompress = None
+        self._rebuilt_from_delta = None
+        # only allocated once somebody asks for the full payload. a server
+        # that's just relaying chunks along to other nodes never needs one
+        self._reassembly_buffer = None
+        # releases the chunks' share of the memory budget, while they're
+        # held onto as they came in
+        self._release_memory = None
 
     @property
     async def full_payload(self):
-        all_chunks = await asyncio.gather(*self._chunk_futures)
-        return pickle.loads(b''.join(chunk.data for chunk in all_chunks))
+        with tracing.span(tracing.trace_id_of(self.metadata), 'reassemble'):
+            return pickle.loads(await self.serialized)
+
+    @property
+    async def serialized(self):
+        if self.is_cancelled:
+            raise MessageCancelledError
+        if not self._reassembly_buffer:
+            self._start_reassembling()
+        for chunk_future in self._chunk_futures:
+            await self._wait_for_chunk(chunk_future)
+        if self.delta:
+            return self._rebuild_from_delta()
+        return self._reassembly_buffer.payload
 
     @property
     async def chunks(self):
         # i'm pretty sure we actually do receive the chunks in order. if not,
         # then using asyncio.as_completed here will yield the chunks as they're
         # available, instead of in ascending order
+        try:
+            for chunk_future in self._chunk_futures:
+                chunk = await self._wait_for_chunk(chunk_future)
+                # a newer message replaced this one. whatever chunks we've
+                # already got aren't worth sending along anymore
+                if self.is_cancelled:
+                    return
+                yield chunk
+        except MessageCancelledError:
+            return
+
+    def cancel(self):
+        # too late to cancel once everything's been received
+        if self.is_cancelled or self.is_done:
+            return
+        self.is_cancelled = True
         for chunk_future in self._chunk_futures:
-            yield (await chunk_future)
+            chunk_future.cancel()
+        self._reassembly_buffer = None
+
+    # we don't know exactly how big the message is until the last chunk comes
+    # in, but all the others are the same size as the first one we got
+    @property
+    def size(self):
+        return self._chunk_size * self.num_chunks
+
+    # the size of the chunks once they're decompressed. for a delta, the size
+    # of the chunks the full content was split into
+    @property
+    def split_size(self):
+        if self.delta:
+            return self.delta['split_size']
+        if self._reassembly_buffer:
+            return self._reassembly_buffer.split_size
+        return self._chunk_size
+
+    # the compression the chunks came in with, if any. chunks handed out by
+    # `chunks` are always exactly as they came in
+    @property
+    def compression(self):
+        return self.metadata.get('compression')
+
+    # if the message is a delta, this says what it's a delta against
+    @property
+    def delta(self):
+        return self.metadata.get('delta')
+
+    # the chunks are relayed along exactly as they came in. only the node a
+    # message came from decides how to split it
+    def resplit(self, split_size):
+        return self
+
+    # only the node a message came from decides whether to compress it.
+    # everyone else passes it along the way it came in
+    @property
+    def is_worth_compressing(self):
+        return False
+
+    # the same goes for deltas. a delta that came in is relayed as it is, or
+    # rebuilt into the full content for a peer that can't use it
+    @property
+    def is_worth_sending_as_delta(self):
+        return False
 
     def set_result(self, chunk):
+        if self.is_cancelled:
+            return
+        if self._chunk_size is None:
+            self._chunk_size = len(chunk.data)
+            # the chunks would otherwise all be held onto in memory until
+            # the whole message is through, so they count towards the memory
+            # budget. once over it, put them into a temporary file as they
+            # come in instead. compressed chunks still get held onto, to be
+            # passed along as they are
+            if not self._reassembly_buffer:
+                if (not self.compression and
+                        memory.budget.would_spill(self.size)):
+                    self._start_reassembling()
+                else:
+                    self._release_memory = memory.budget.reserve(self,
+                                                                 self.size)
+        if self._reassembly_buffer:
+            chunk = self._write_to_reassembly_buffer(chunk)
         self._chunk_futures[chunk.chunk_index].set_result(chunk)
 
     @property
     def is_done(self):
         return all(future.done() for future in self._chunk_futures)
 
+    # several consumers wait on the same chunk futures, so shield them.
+    # otherwise one consumer getting cancelled would cancel the chunk for
+    # everybody else too
+    async def _wait_for_chunk(self, chunk_future):
+        try:
+            return await asyncio.shield(chunk_future)
+        except asyncio.CancelledError:
+            if chunk_future.cancelled():
+                raise MessageCancelledError
+            raise
+
+    def _rebuild_from_delta(self):
+        if self._rebuilt_from_delta is None:
+            base = self._cache.serialized_for(self.delta['base'])
+            if base is None:
+                raise MissingBaseError(self.delta['base'])
+            self._rebuilt_from_delta = apply_delta(
+                base, self._reassembly_buffer.payload)
+        return self._rebuilt_from_delta
+
+    def _start_reassembling(self):
+        self._reassembly_buffer = ReassemblyBuffer(self.num_chunks)
+        if self.compression:
+            self._decompress = \
+                COMPRESSION_BY_NAME[self.compression].decompress_chunks()
+        # copy over whatever chunks came in before anybody wanted the payload
+        for index, future in enumerate(self._chunk_futures):
+            if future.done():
+                self._chunk_futures[index] = asyncio.Future()
+                self._chunk_futures[index].set_result(
+                    self._write_to_reassembly_buffer(future.result()))
+        # the buffer counts towards the budget by itself, and uncompressed
+        # chunks only live in there from now on
+        if self._release_memory and not self._decompress:
+            self._release_memory()
+
+    # returns the chunk to hand out to anybody reading `chunks`. if the chunk
+    # isn't compressed, that's the copy in the reassembly buffer, so we don't
+    # hang onto the chunk we received as well
+    def _write_to_reassembly_buffer(self, chunk):
+        if not self._decompress:
+            return self._reassembly_buffer.write(chunk)
+        # chunks come in order, which is the order they have to be
+        # decompressed in
+        decompressed_chunk = Chunk(chunk_index=chunk.chunk_index,
+                                   total_chunks=chunk.total_chunks,
+                                   data=self._decompress(chunk.data),
+                                   message_hash=chunk.message_hash)
+        self._reassembly_buffer.write(decompressed_chunk)
+        return chunk
+
+
+# a delta is no good to anybody who doesn't have what it's against, like
+# another worker, so this rebuilds it into a message with the full content.
+# returns None if it can't be rebuilt, because it was cancelled or the base
+# is no longer cached
+async def without_delta(message):
+    if not message.metadata.get('delta'):
+        return message
+    try:
+        serialized = await message.serialized
+    except (MessageCancelledError, MissingBaseError):
+        return None
+    return Message.from_serialized(
+        serialized, split_size=message.split_size,
+        metadata={key: value for key, value in message.metadata.items()
+                  if key not in ('compression', 'delta')})
+
+
+class ReassemblyBuffer:
+    """Puts a message back together by writing each chunk straight into one
+    buffer, at the chunk's offset, as the chunk comes in.
+
+    Every chunk except for the last one is the same size, so after seeing any
+    one of those, we know where every chunk goes, and that the whole message
+    fits into num_chunks of them. The payload can then be decoded right out of
+    the buffer, without joining anything.
+    """
+
+    def __init__(self, num_chunks):
+        self._num_chunks = num_chunks
+        self._split_size = None
+        self._buffer = None
+        self._payload_length = 0
+        self._unplaced_last_chunk = None
+
+    @property
+    def payload(self):
+        return memoryview(self._buffer)[:self._payload_length]
+
+    @property
+    def split_size(self):
+        return self._split_size
+
+    # returns a copy of the chunk whose data points into the buffer, so the
+    # caller can let go of the original
+    def write(self, chunk):
+        if self._buffer is None:
+            if chunk.is_the_last_chunk and not chunk.is_the_first_chunk:
+                # the last chunk can be shorter than the others, so it doesn't
+                # tell us where it goes. hold onto it until another chunk does
+                self._unplaced_last_chunk = chunk
+                return chunk
+            self._allocate(split_size=len(chunk.data))
+
+        written_chunk = self._place(chunk)
+        if self._unplaced_last_chunk:
+            self._place(self._unplaced_last_chunk)
+            self._unplaced_last_chunk = None
+        return written_chunk
+
+    def _allocate(self, split_size):
+        self._split_size = split_size
+        self._buffer = memory.budget.allocate(split_size * self._num_chunks)
+
+    def _place(self, chunk):
+        offset = chunk.chunk_index * self._split_size
+        end = offset + len(chunk.data)
+        view = memoryview(self._buffer)[offset:end]
+        view[:] = chunk.data
+        self._payload_length = max(self._payload_length, end)
+        return Chunk(chunk_index=chunk.chunk_index,
+                     total_chunks=chunk.total_chunks, data=view,
+                     message_hash=chunk.message_hash)
+
 
 if __name__ == '__main__':
-    from chunked_sending import Splitter
+    import os
+
+    from .chunked_sending import Splitter
 
     def assert_equal(lhs, rhs):
         if lhs != rhs:
@@ -89,10 +367,15 @@ if __name__ == '__main__':
 
     teststring_a = b'the quick lazy frox jumps over the lazy dog'
     teststring_b = b'the quick lazy frox jumps over the lrazy duuuuug'
+    # big enough to get reassembled in an mmap
+    teststring_c = os.urandom(memory.MMAP_THRESHOLD_BYTES)
+    test_splits = [(teststring_a, 3), (teststring_b, 3),
+                   (teststring_c, 100_000)]
 
     async def new_chunk_generator():
-        for teststring in [teststring_a, teststring_b]:
-            for split in  Splitter.split(teststring, split_size=3):
+        for teststring, split_size in test_splits:
+            serialized = pickle.dumps(teststring)
+            for split in Splitter.split(serialized, split_size=split_size):
                 await asyncio.sleep(0.001)
                 yield split
 
@@ -103,5 +386,6 @@ if __name__ == '__main__':
             received_full_payloads.append(await message.full_payload)
         assert_equal(teststring_a, received_full_payloads[0])
         assert_equal(teststring_b, received_full_payloads[1])
+        assert_equal(teststring_c, received_full_payloads[2])
 
     asyncio.get_event_loop().run_until_complete(test())
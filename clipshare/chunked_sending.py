@@ -1,44 +1,179 @@
 from collections import namedtuple
+import hashlib
 import math
 import pickle
+import time
 
 from cached_property import cached_property
 
+from . import compression
+from . import delta
+from . import memory
+from . import tracing
+
 
 class Message:
 
-    def __init__(self, payload, *, split_size):
+    # metadata travels along with the message, on its first chunk. it has to
+    # be JSON serializable
+    def __init__(self, payload, *, split_size, metadata=None):
+        self.is_cancelled = False
+        self.split_size = split_size
         self._payload = payload
-        self._split_size = split_size
+        self._extra_metadata = metadata or {}
+
+    # for sending along content that's already been serialized, e.g. out of
+    # the payload cache
+    @classmethod
+    def from_serialized(cls, serialized, *, split_size, metadata):
+        message = cls(payload=None, split_size=split_size, metadata=metadata)
+        message._serialized = serialized
+        return message
 
     @property
     async def full_payload(self):
+        if self._payload is None:
+            self._payload = pickle.loads(self._serialized)
         return self._payload
 
+    @property
+    async def serialized(self):
+        return self._serialized
+
+    # the time spent splitting is only the time spent in the splitter, not
+    # whatever happens to the chunks in between
     @property
     async def chunks(self):
-        for chunk in self._splitter.splits:
+        started_at = time.time()
+        splitting_seconds = 0
+        splits = self._splitter.splits
+        while True:
+            split_started_at = time.perf_counter()
+            chunk = next(splits, None)
+            splitting_seconds += time.perf_counter() - split_started_at
+            # stop splitting as soon as a newer message replaces this one
+            if chunk is None or self.is_cancelled:
+                break
             yield chunk
+        tracing.record(tracing.trace_id_of(self._extra_metadata), 'split',
+                       started_at=started_at, seconds=splitting_seconds)
+
+    def cancel(self):
+        self.is_cancelled = True
+
+    # the same message, split into chunks of a different size. nothing gets
+    # serialized or digested over again
+    def resplit(self, split_size):
+        if split_size == self.split_size:
+            return self
+        message = type(self)(self._payload, split_size=split_size,
+                             metadata=self._extra_metadata)
+        message._serialized = self._serialized
+        message.digest = self.digest
+        return message
+
+    # metadata passed in wins. a delta, for one, carries the digest of the
+    # content it rebuilds into, not of the delta itself
+    @cached_property
+    def metadata(self):
+        return {'digest': self.digest.hex(), **self._extra_metadata}
 
     @property
     def num_chunks(self):
         return self._splitter.num_chunks
 
+    @property
+    def size(self):
+        return len(self._serialized)
+
+    # decided up front, by whoever sends the message out first. messages are
+    # compressed on the way out of that node, and passed along compressed
+    @cached_property
+    def is_worth_compressing(self):
+        mime_types = list(self._payload) if self._payload else ()
+        return compression.is_worth_compressing(self._serialized, mime_types)
+
+    # only the node a message came from sends it as a delta, the same as with
+    # compression. content that doesn't compress, like images, rarely has
+    # blocks in common with its previous version either, so don't bother
+    # cutting it up to find out
+    @cached_property
+    def is_worth_sending_as_delta(self):
+        return (self._payload is not None and
+                self.size <= delta.MAX_DELTA_BYTES and
+                self.is_worth_compressing)
+
     @cached_property
     def hash(self):
-        return message_hash(self._payload)
+        return message_hash_from_digest(self.digest)
+
+    @cached_property
+    def digest(self):
+        return content_digest(self._serialized)
 
     @cached_property
     def _splitter(self):
-        return Splitter(self._serialized, split_size=self._split_size)
+        return Splitter(self._serialized, split_size=self.split_size,
+                        message_hash=self.hash)
 
     @cached_property
     def _serialized(self):
-        return pickle.dumps(self._payload)
+        with tracing.span(tracing.trace_id_of(self._extra_metadata),
+                          'serialize'):
+            return serialize(self._payload)
+
+
+# identifies content across machines and processes, unlike the builtin hash()
+# which is randomized per process. it's also what the payload cache is keyed by
+def content_digest(serialized):
+    return hashlib.blake2b(serialized, digest_size=16).digest()
+
+
+# the chunk header has room for a signed 64 bit hash
+def message_hash(serialized):
+    return message_hash_from_digest(content_digest(serialized))
 
 
-def message_hash(message):
-    return hash(message)
+def message_hash_from_digest(digest):
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+# pickle.dumps grows its output buffer as it goes, which peaks at around 1.5x
+# the size of the pickle for big payloads. instead, pickle once just to count
+# the bytes, and then again straight into a buffer of exactly the right size.
+# when pickling to a file, the pickler hands over big bytes objects as they
+# are, so counting them is free. the buffer comes out of the memory budget, so
+# it might be a temporary file (see memory.py)
+def serialize(payload):
+    byte_counter = _ByteCounter()
+    pickle.Pickler(byte_counter).dump(payload)
+    serialized = memory.budget.allocate(byte_counter.count)
+    pickle.Pickler(_BufferWriter(serialized)).dump(payload)
+    return serialized
+
+
+class _ByteCounter:
+
+    def __init__(self):
+        self.count = 0
+
+    def write(self, data):
+        num_bytes = memoryview(data).nbytes
+        self.count += num_bytes
+        return num_bytes
+
+
+class _BufferWriter:
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer)
+        self._offset = 0
+
+    def write(self, data):
+        num_bytes = memoryview(data).nbytes
+        self._view[self._offset:self._offset+num_bytes] = data
+        self._offset += num_bytes
+        return num_bytes
 
 
 class Splitter:
@@ -47,9 +182,11 @@ class Splitter:
     def split(cls, *args, **kwargs):
         return cls(*args, **kwargs).splits
 
-    def __init__(self, message, *, split_size):
+    def __init__(self, message, *, split_size, message_hash=None):
         self._message = message
         self._split_size = split_size
+        if message_hash is not None:
+            self._message_hash = message_hash
 
     @property
     def splits(self):
@@ -69,33 +206,25 @@ class Splitter:
         return message_hash(self._message)
 
 
+# slicing a memoryview doesn't copy, so every chunk's data is a view into the
+# one serialized message, and goes all the way out to the websocket like that
 def segment(string, split_size):
-    for starting_index in range(0, len(string), split_size):
-        yield string[starting_index:starting_index+split_size]
-
-
-class Rejoiner:
-
-    def __init__(self):
-        self._chunks_by_hash = {}
-
-    def process_incoming_chunk(self, chunk):
-        if chunk.message_hash not in self._chunks_by_hash:
-            self._chunks_by_hash[chunk.message_hash] = ([self._zero] *
-                                                        chunk.total_chunks)
+    view = memoryview(string)
+    for starting_index in range(0, len(view), split_size):
+        yield view[starting_index:starting_index+split_size]
 
-        collected_chunks = self._chunks_by_hash[chunk.message_hash]
-        collected_chunks[chunk.chunk_index] = chunk.data
 
-        if all(chunk is not self._zero for chunk in collected_chunks):
-            del self._chunks_by_hash[chunk.message_hash]
-            return b''.join(chunk for chunk in collected_chunks)
-
-    class _zero: pass
+class MessageCancelledError(Exception):
+    pass
 
 
 class Chunk(namedtuple('Chunk', 'chunk_index total_chunks data message_hash')):
 
+    # chunks in the legacy pickle format don't carry any metadata
+    @property
+    def metadata(self):
+        return {}
+
     @property
     def is_the_first_chunk(self):
         return self.chunk_index == 0
@@ -103,3 +232,37 @@ class Chunk(namedtuple('Chunk', 'chunk_index total_chunks data message_hash')):
     @property
     def is_the_last_chunk(self):
         return self.chunk_index == self.total_chunks - 1
+
+
+if __name__ == '__main__':
+    import asyncio
+    import os
+    import tracemalloc
+
+    from .frames import FrameCodec
+
+    PAYLOAD_SIZE = 50_000_000
+
+    async def encode_all_chunks(message):
+        codec = FrameCodec()
+        async for chunk in message.chunks:
+            codec.encode(chunk)
+
+    payload = {'image/png': os.urandom(PAYLOAD_SIZE)}
+    message = Message(payload, split_size=100_000)
+    # the serialized message is an mmap out of the memory budget, which
+    # tracemalloc doesn't see. the budget keeps count of it instead
+    memory.budget = memory.MemoryBudget(max_in_memory_bytes=2 * PAYLOAD_SIZE)
+
+    tracemalloc.start()
+    asyncio.get_event_loop().run_until_complete(encode_all_chunks(message))
+    _, heap_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    peak = heap_peak + memory.budget.in_memory_bytes
+
+    # serializing the message takes one copy of the payload. splitting and
+    # encoding the chunks shouldn't take any more memory than that
+    print(f'peak memory while sending a {PAYLOAD_SIZE} byte payload: {peak} '
+          f'bytes ({peak / PAYLOAD_SIZE:.2f}x the payload), {heap_peak} of '
+          'them on the heap')
+    assert PAYLOAD_SIZE <= peak < 1.1 * PAYLOAD_SIZE
@@ -9,12 +9,14 @@ from quamash import QEventLoop
 import websockets
 
 from .client_relay_node import ClientRelayNode
+from .frames import SUBPROTOCOLS
 from .local_clipboard import LocalClipboard
 from . import log
 from .relay import Relay
 from .remote_relay_node import RemoteRelayNode
 from . import signals
 from .ui import UI
+from .websocket import COMPRESSION
 from .websocket import MAX_PAYLOAD_SIZE
 from .websocket import keepalive_forever
 
@@ -33,6 +35,10 @@ class Client:
 
         self._relay = relay
         self._websocket_future = None
+        # carried over from one connection to the next, so the server doesn't
+        # send over what's on the clipboard again after reconnecting if
+        # nothing changed
+        self._last_seen_digest = None
 
     def connect(self):
         if self.is_active:
@@ -44,19 +50,24 @@ class Client:
         self._websocket_future.add_done_callback(self._client_future_done)
 
     async def _establish_connection(self):
-        connect_fut = websockets.connect(self.ws_url, max_size=MAX_PAYLOAD_SIZE)
+        connect_fut = websockets.connect(self.ws_url, max_size=MAX_PAYLOAD_SIZE,
+                                         compression=COMPRESSION,
+                                         subprotocols=SUBPROTOCOLS)
         websocket = None
         try:
             websocket = await asyncio.wait_for(connect_fut, timeout=CONNECTION_ESTABLISH_TIMEOUT)
         except asyncio.TimeoutError:
-            logger.debug(f'timed out connecting to {self.ws_url}')
+            logger.debug('timed out connecting to %s', self.ws_url)
             return
 
+        node = RemoteRelayNode(websocket,
+                               last_seen_digest=self._last_seen_digest)
         try:
             signals.connection_established.send()
-            with self._relay.with_node(RemoteRelayNode(websocket)):
+            with self._relay.with_node(node):
                 await keepalive_forever(websocket)
         finally:
+            self._last_seen_digest = node.last_seen_digest
             await websocket.close()
 
     def disconnect(self):
@@ -88,6 +99,6 @@ class Client:
         ensure_future(self._wait_and_reconnect())
 
     async def _wait_and_reconnect(self):
-        logger.info(f'waiting {RECONNECT_WAIT_SECONDS} before reconnecting')
+        logger.info('waiting %s before reconnecting', RECONNECT_WAIT_SECONDS)
         await asyncio.sleep(RECONNECT_WAIT_SECONDS)
         self.connect()
@@ -1,16 +1,39 @@
+import asyncio
 from asyncio import ensure_future
+import functools
+import itertools
+import os
+import uuid
 
 from asyncblink import AsyncSignal
 
 from .chunked_sending import Message
+from .chunked_sending import MessageCancelledError
+from .delta import MissingBaseError
+from . import image
 from . import log
 from . import signals
+from . import tracing
 from .transfer_progress import ProgressSignaler
 
 
-# TODO: tune this value to see if it affects speed
+# TODO: tune this value to see if it affects speed. python -m
+# clipshare.benchmark sweeps it
 BYTES_PER_SPLIT = 100_000
 
+# send a small preview of big images first, so there's something to paste on
+# the other side while the full image is still on its way
+PROGRESSIVE_IMAGES = os.environ.get('CLIPSHARE_PROGRESSIVE_IMAGES') == '1'
+
+# in lazy mode, copying something only sends a manifest saying what's on the
+# clipboard. the contents themselves are fetched from where they were copied
+# once something actually gets pasted, which for most copies is never. text
+# smaller than this is still sent along eagerly, it's cheap enough
+LAZY_CLIPBOARD = os.environ.get('CLIPSHARE_LAZY_CLIPBOARD') == '1'
+EAGER_TEXT_MAX_BYTES = int(os.environ.get('CLIPSHARE_EAGER_TEXT_MAX_BYTES',
+                                          64 * 1024))
+FETCH_TIMEOUT_SECONDS = 30
+
 
 logger = log.getLogger(__name__)
 
@@ -20,9 +43,33 @@ class ClientRelayNode:
     def __init__(self, clipboard):
         self.new_message_signal = AsyncSignal()
         self._clipboard = clipboard
+        # every message we send is tagged with where it came from, and a
+        # number that goes up with every copy. that lets everyone down the
+        # line tell when a message has been replaced by a newer one
+        self._origin = uuid.uuid4().hex
+        self._sequence_numbers = itertools.count()
         self._progress_signaler = ProgressSignaler(signals.incoming_transfer)
+        # the relay sends messages meant for us, like fetches of our lazy
+        # clipboard contents, our way
+        self.origins = {self._origin}
+        # the contents of the latest lazy copy, for anybody who fetches them
+        self._lazy_message = None
+        # digest -> future resolving to the contents we asked for
+        self._pending_fetches = {}
+        # making the preview of the latest copy, if it's still going
+        self._preview_task = None
 
     async def accept_relayed_message(self, message):
+        if 'fetch' in message.metadata:
+            await self._handle_fetch(message)
+        elif 'fetched' in message.metadata:
+            await self._handle_fetched(message)
+        elif message.metadata.get('manifest'):
+            await self._handle_manifest(message)
+        else:
+            await self._set_clipboard_from(message)
+
+    async def _set_clipboard_from(self, message):
         # we receive the message here after receiving the first chunk fully. up
         # to this point, we haven't gotten the entire message.
         #
@@ -33,20 +80,148 @@ class ClientRelayNode:
         # you'll end up the previous item on the clipboard.
 
         # clearing the clipboard in anticipation of new contents being
-        # downloaded will prevent accidental pasting.
-        logger.debug('got wind of a message, clearing the clipboard')
-        self._clipboard.clear()
+        # downloaded will prevent accidental pasting. unless a preview of the
+        # image is already on the clipboard, that's fine to paste in the
+        # meantime
+        if message.metadata.get('has_preview'):
+            logger.debug('got wind of the full image, leaving the preview on '
+                         'the clipboard until it comes in')
+        else:
+            logger.debug('got wind of a message, clearing the clipboard')
+            self._clipboard.clear()
         logger.debug('actually setting the clipboard')
         ensure_future(self._broadcast_incoming_transfer_progress(message))
-        self._clipboard.set(await message.full_payload)
+        try:
+            full_payload = await message.full_payload
+        except MessageCancelledError:
+            # something newer got copied before this finished downloading.
+            # that newer message is what belongs on the clipboard
+            logger.debug('message was superseded, not setting the clipboard')
+            return
+        except MissingBaseError as e:
+            logger.warning('not setting the clipboard: %s', e)
+            return
+        self._clipboard.set(full_payload,
+                            trace_id=tracing.trace_id_of(message.metadata))
+
+    # there's no connection to drop for the local clipboard. messages that
+    # don't fit in its queue just get thrown away
+    def disconnect(self):
+        logger.debug('asked to disconnect the local clipboard, ignoring')
 
     def start_relaying_changes(self):
         self._clipboard.new_clipboard_contents_signal.connect(
             self._handle_new_clipboard_contents_signal)
         self._clipboard.start_listening_for_changes()
 
-    def _handle_new_clipboard_contents_signal(self, clipboard_contents):
-        message = Message(payload=clipboard_contents, split_size=BYTES_PER_SPLIT)
+    # the manifest takes the place of the contents on the clipboard. for
+    # clipboards that can't hold contents that aren't there yet, fetch them
+    # right away
+    async def _handle_manifest(self, message):
+        manifest = await message.full_payload
+        logger.debug('got a manifest for %s: %s', manifest['digest'],
+                     manifest['mime_types'])
+        fetch = functools.partial(self._fetch, manifest['digest'],
+                                  message.metadata['origin'])
+        if hasattr(self._clipboard, 'set_lazy'):
+            self._clipboard.set_lazy(list(manifest['mime_types']), fetch)
+            return
+        self._clipboard.clear()
+        try:
+            self._clipboard.set(await fetch())
+        except asyncio.TimeoutError:
+            logger.debug('gave up fetching %s', manifest['digest'])
+
+    async def _fetch(self, digest, origin):
+        if digest not in self._pending_fetches:
+            self._pending_fetches[digest] = asyncio.Future()
+            logger.debug('fetching %s from %s', digest, origin)
+            self._send({}, to=origin, fetch=digest)
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(self._pending_fetches[digest]),
+                FETCH_TIMEOUT_SECONDS)
+        finally:
+            self._pending_fetches.pop(digest, None)
+
+    async def _handle_fetch(self, message):
+        digest = message.metadata['fetch']
+        lazy_message = self._lazy_message
+        if not lazy_message or lazy_message.metadata['digest'] != digest:
+            logger.debug('asked for %s, which is no longer on the clipboard, '
+                         'ignoring', digest)
+            return
+        logger.debug('sending %s to %s', digest, message.metadata['origin'])
+        self.new_message_signal.send(Message.from_serialized(
+            await lazy_message.serialized, split_size=BYTES_PER_SPLIT,
+            metadata={'origin': self._origin, 'to': message.metadata['origin'],
+                      'fetched': digest}))
+
+    async def _handle_fetched(self, message):
+        digest = message.metadata['fetched']
+        ensure_future(self._broadcast_incoming_transfer_progress(message))
+        try:
+            full_payload = await message.full_payload
+        except MessageCancelledError:
+            return
+        pending_fetch = self._pending_fetches.get(digest)
+        if pending_fetch and not pending_fetch.done():
+            pending_fetch.set_result(full_payload)
+
+    # clipboards that trace their copies hand over the trace id. the rest of
+    # the copy's trip gets traced under it
+    def _handle_new_clipboard_contents_signal(self, clipboard_contents,
+                                              trace_id=None):
+        # whatever was copied before this is out of date, no sense in
+        # finishing its preview and sending it
+        if self._preview_task:
+            self._preview_task.cancel()
+            self._preview_task = None
+        sequence = next(self._sequence_numbers)
+        trace_metadata = tracing.trace_metadata(
+            trace_id or tracing.new_trace_id())
+        if LAZY_CLIPBOARD and not _is_small_text(clipboard_contents):
+            self._send_manifest(clipboard_contents, sequence, trace_metadata)
+        elif PROGRESSIVE_IMAGES and image.is_worth_previewing(clipboard_contents):
+            self._preview_task = ensure_future(self._send_with_preview(
+                clipboard_contents, sequence, trace_metadata))
+        else:
+            self._send(clipboard_contents, sequence=sequence, **trace_metadata)
+
+    # the preview and the full image go out as two separate messages with the
+    # same sequence number. the full image replaces the preview, but doesn't
+    # cancel it, and anything copied afterwards replaces both
+    #
+    # if there's no making a preview out of the image, the full image still
+    # goes out on its own
+    async def _send_with_preview(self, clipboard_contents, sequence,
+                                 trace_metadata):
+        try:
+            preview_contents = await image.make_preview(clipboard_contents)
+        except Exception as e:
+            logger.warning("couldn't make a preview, sending the full image "
+                           'without one: %r', e)
+            self._send(clipboard_contents, sequence=sequence, **trace_metadata)
+            return
+        self._send(preview_contents, sequence=sequence, preview=True,
+                   **trace_metadata)
+        self._send(clipboard_contents, sequence=sequence, has_preview=True,
+                   **trace_metadata)
+
+    def _send_manifest(self, clipboard_contents, sequence, trace_metadata):
+        self._lazy_message = Message(payload=clipboard_contents,
+                                     split_size=BYTES_PER_SPLIT)
+        manifest = {'digest': self._lazy_message.metadata['digest'],
+                    'mime_types': {mime_type: len(data) for mime_type, data
+                                   in clipboard_contents.items()}}
+        self._send(manifest, sequence=sequence, manifest=True,
+                   **trace_metadata)
+
+    # messages that aren't copies, like fetches, don't have a sequence
+    # number. they don't replace anything
+    def _send(self, payload, **metadata):
+        message = Message(payload=payload, split_size=BYTES_PER_SPLIT,
+                          metadata={'origin': self._origin, **metadata})
         self.new_message_signal.send(message)
 
     def __repr__(self):
@@ -56,3 +231,10 @@ class ClientRelayNode:
         self._progress_signaler.begin_transfer(message)
         async for chunk in message.chunks:
             self._progress_signaler.on_chunk_transferred()
+        if message.is_cancelled:
+            self._progress_signaler.cancel_transfer()
+
+
+def _is_small_text(clipboard_contents):
+    return (set(clipboard_contents) <= {'text/plain'} and
+            sum(map(len, clipboard_contents.values())) < EAGER_TEXT_MAX_BYTES)
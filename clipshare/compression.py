@@ -0,0 +1,136 @@
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import chunked_sending
+from . import log
+
+
+logger = log.getLogger(__name__)
+
+
+# PNGs from the clipboard are already compressed, so compressing them again
+# just burns CPU. text, on the other hand, usually shrinks 5-10x
+ALREADY_COMPRESSED_MIME_TYPES = {'image/png', 'image/jpeg', 'image/gif',
+                                 'image/webp'}
+# not worth the overhead for anything smaller
+MIN_COMPRESSIBLE_BYTES = 1024
+# how much of the payload to try compressing before deciding whether the rest
+# of it is worth compressing
+SAMPLE_SIZE_BYTES = 64 * 1024
+# the sample has to shrink at least this much
+MAX_SAMPLE_RATIO = 0.9
+
+
+# messages are compressed chunk by chunk, as they're sent, so the first chunk
+# still goes out right away. every chunk is flushed, so it decompresses into
+# exactly the uncompressed chunk it came from. that means a compressed message
+# has the same number of chunks as the uncompressed one, and each chunk can be
+# decompressed as soon as it comes in
+class ZlibCompression:
+
+    name = 'zlib'
+
+    def compress_chunks(self):
+        compressobj = zlib.compressobj(6)
+        return lambda data: (compressobj.compress(data) +
+                             compressobj.flush(zlib.Z_SYNC_FLUSH))
+
+    def decompress_chunks(self):
+        return zlib.decompressobj().decompress
+
+
+class ZstdCompression:
+
+    name = 'zstd'
+
+    def compress_chunks(self):
+        compressobj = zstandard.ZstdCompressor(level=3).compressobj()
+        return lambda data: (compressobj.compress(data) +
+                             compressobj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+
+    def decompress_chunks(self):
+        return zstandard.ZstdDecompressor().decompressobj().decompress
+
+
+# in order of preference. zstd is optional, and only used if it's installed
+COMPRESSIONS = ([ZstdCompression()] if zstandard else []) + [ZlibCompression()]
+COMPRESSION_BY_NAME = {compression.name: compression
+                       for compression in COMPRESSIONS}
+SUPPORTED_COMPRESSIONS = [compression.name for compression in COMPRESSIONS]
+
+
+def is_worth_compressing(serialized, mime_types):
+    if len(serialized) < MIN_COMPRESSIBLE_BYTES:
+        return False
+    if mime_types and set(mime_types) <= ALREADY_COMPRESSED_MIME_TYPES:
+        return False
+    sample = bytes(serialized[:SAMPLE_SIZE_BYTES])
+    return len(zlib.compress(sample, 1)) <= len(sample) * MAX_SAMPLE_RATIO
+
+
+# picks the compression to send a message with, out of the ones the other
+# side told us it understands
+def choose_compression(peer_compressions):
+    return next((name for name in SUPPORTED_COMPRESSIONS
+                 if name in peer_compressions), None)
+
+
+# converts a stream of chunks compressed with one compression (or None) into
+# one compressed with another
+async def transcode_chunks(chunks, *, from_compression, to_compression):
+    decompress = (COMPRESSION_BY_NAME[from_compression].decompress_chunks()
+                  if from_compression else None)
+    compress = (COMPRESSION_BY_NAME[to_compression].compress_chunks()
+                if to_compression else None)
+    stats = TranscodingStats(from_compression, to_compression)
+
+    async for chunk in chunks:
+        data = chunk.data
+        started_at = time.perf_counter()
+        if decompress:
+            data = decompress(data)
+        uncompressed_size = len(data)
+        if compress:
+            data = compress(data)
+        stats.add(len(chunk.data), uncompressed_size, len(data),
+                  time.perf_counter() - started_at)
+        yield chunked_sending.Chunk(chunk_index=chunk.chunk_index,
+                                    total_chunks=chunk.total_chunks,
+                                    data=data,
+                                    message_hash=chunk.message_hash)
+
+    stats.log()
+
+
+class TranscodingStats:
+
+    def __init__(self, from_compression, to_compression):
+        self._from_compression = from_compression
+        self._to_compression = to_compression
+        self._bytes_in = 0
+        self._uncompressed_bytes = 0
+        self._bytes_out = 0
+        self._seconds = 0
+
+    def add(self, bytes_in, uncompressed_bytes, bytes_out, seconds):
+        self._bytes_in += bytes_in
+        self._uncompressed_bytes += uncompressed_bytes
+        self._bytes_out += bytes_out
+        self._seconds += seconds
+
+    def log(self):
+        if self._to_compression:
+            ratio = self._bytes_out / max(self._uncompressed_bytes, 1)
+            logger.debug('%s compression stats: %d bytes in, %d bytes out, '
+                         'ratio %.3f, took %.1fms', self._to_compression,
+                         self._uncompressed_bytes, self._bytes_out, ratio,
+                         self._seconds * 1000)
+        else:
+            logger.debug('%s decompression stats: %d bytes in, %d bytes out, '
+                         'took %.1fms', self._from_compression, self._bytes_in,
+                         self._uncompressed_bytes, self._seconds * 1000)
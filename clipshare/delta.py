@@ -0,0 +1,188 @@
+from collections import OrderedDict
+import hashlib
+import random
+import struct
+import threading
+
+
+# rsync style deltas, for when the same big thing gets copied over and over
+# with small changes, like a log file. both versions are cut into blocks at
+# content defined boundaries, so inserting a line near the top only changes
+# the block it landed in, instead of shifting every fixed size block after it.
+# blocks the other side already has in the old version are sent as references
+# into it, and only the rest is sent for real.
+#
+# a delta is a list of ops, one after the other:
+#
+#   OP_COPY, offset (8 bytes), length (4 bytes): copy from the old version
+#   OP_LITERAL, length (4 bytes), data: data that's only in the new version
+#
+# everything is big endian
+OP_COPY = b'C'
+OP_LITERAL = b'L'
+COPY = struct.Struct('!cQI')
+LITERAL = struct.Struct('!cI')
+
+# block boundaries are where the rolling gear hash has all of these bits unset,
+# which works out to blocks of around 8KB on average
+BOUNDARY_MASK = (1 << 13) - 1
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 64 * 1024
+
+# the gear table has to be the same everywhere, so it's generated from a fixed
+# seed rather than randomly on startup
+GEAR = [random.Random(i).getrandbits(32) for i in range(256)]
+
+# cutting content up into blocks goes byte by byte, in python, at a few MB a
+# second. past this, it's quicker to just send the whole thing
+MAX_DELTA_BYTES = 4_000_000
+
+MAX_CACHED_BLOCK_LISTS = 4
+_blocks_by_digest = OrderedDict()
+# deltas get made on executor threads
+_blocks_by_digest_lock = threading.Lock()
+
+
+class MissingBaseError(Exception):
+
+    def __init__(self, base_digest):
+        self.base_digest = base_digest
+
+    def __str__(self):
+        return (f'received a delta against {self.base_digest}, but that '
+                'content is no longer cached')
+
+
+# the digests are of the whole contents of base and target. whatever gets sent
+# next is usually a delta against what's being sent now, so hang onto the
+# blocks we cut target into, keyed by its digest, to save cutting it up again
+def make_delta(base, target, *, base_digest, target_digest):
+    block_offsets_by_digest = {}
+    for start, _, block_digest in _blocks(base, base_digest):
+        block_offsets_by_digest.setdefault(block_digest, start)
+
+    ops = []
+    literal_start = None
+    target_view = memoryview(target)
+    for start, end, block_digest in _blocks(target, target_digest):
+        base_offset = block_offsets_by_digest.get(block_digest)
+        if base_offset is None:
+            if literal_start is None:
+                literal_start = start
+            continue
+        if literal_start is not None:
+            ops.append(_literal(target_view[literal_start:start]))
+            literal_start = None
+        _append_copy(ops, base_offset, end - start)
+    if literal_start is not None:
+        ops.append(_literal(target_view[literal_start:]))
+    return _join_ops(ops)
+
+
+def apply_delta(base, delta):
+    base_view = memoryview(base)
+    delta_view = memoryview(delta)
+    rebuilt = bytearray()
+    offset = 0
+    while offset < len(delta_view):
+        op = bytes(delta_view[offset:offset+1])
+        if op == OP_COPY:
+            _, base_offset, length = COPY.unpack_from(delta_view, offset)
+            rebuilt += base_view[base_offset:base_offset+length]
+            offset += COPY.size
+        elif op == OP_LITERAL:
+            _, length = LITERAL.unpack_from(delta_view, offset)
+            offset += LITERAL.size
+            rebuilt += delta_view[offset:offset+length]
+            offset += length
+        else:
+            raise ValueError(f'unknown delta op {op}')
+    return rebuilt
+
+
+def block_boundaries(data):
+    # looked up once out here, since this loop runs for every single byte
+    view = memoryview(data)
+    gear = GEAR
+    mask = BOUNDARY_MASK
+    length = len(view)
+    start = 0
+    while start < length:
+        end = min(start + MAX_BLOCK_SIZE, length)
+        # the gear hash only depends on the last 32 bytes it's seen, so
+        # there's no need to hash the bytes before the minimum block size
+        gear_hash = 0
+        index = start + MIN_BLOCK_SIZE
+        for byte in view[index:end]:
+            index += 1
+            gear_hash = ((gear_hash << 1) + gear[byte]) & 0xFFFFFFFF
+            if not gear_hash & mask:
+                end = index
+                break
+        yield start, end
+        start = end
+
+
+def _blocks(data, digest):
+    with _blocks_by_digest_lock:
+        blocks = _blocks_by_digest.get(digest)
+    if blocks is not None:
+        return blocks
+
+    view = memoryview(data)
+    blocks = [(start, end, _block_digest(view[start:end]))
+              for start, end in block_boundaries(view)]
+    with _blocks_by_digest_lock:
+        _blocks_by_digest[digest] = blocks
+        while len(_blocks_by_digest) > MAX_CACHED_BLOCK_LISTS:
+            _blocks_by_digest.popitem(last=False)
+    return blocks
+
+
+def _block_digest(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+# consecutive blocks that were also consecutive in the base become one copy
+def _append_copy(ops, base_offset, length):
+    if ops and isinstance(ops[-1], tuple):
+        last_offset, last_length = ops[-1]
+        if last_offset + last_length == base_offset:
+            ops[-1] = (last_offset, last_length + length)
+            return
+    ops.append((base_offset, length))
+
+
+def _literal(data):
+    return [LITERAL.pack(OP_LITERAL, len(data)), data]
+
+
+def _join_ops(ops):
+    parts = []
+    for op in ops:
+        if isinstance(op, tuple):
+            parts.append(COPY.pack(OP_COPY, *op))
+        else:
+            parts.extend(op)
+    return b''.join(parts)
+
+
+if __name__ == '__main__':
+    import os
+    import time
+
+    lines = [os.urandom(40).hex().encode() + b'\n' for _ in range(25_000)]
+    base = b''.join(lines)
+    lines[100] = b'changed\n'
+    lines.insert(12_000, b'inserted\n')
+    del lines[20_000]
+    target = b''.join(lines)
+
+    for attempt in ('cold', 'warm'):
+        started_at = time.perf_counter()
+        delta = make_delta(base, target, base_digest=b'base',
+                           target_digest=b'target')
+        took = time.perf_counter() - started_at
+        assert apply_delta(base, delta) == target
+        print(f'{attempt}: {len(target)} bytes, delta of {len(delta)} bytes, '
+              f'took {took * 1000:.0f}ms')
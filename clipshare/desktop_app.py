@@ -14,6 +14,7 @@ from .client import Client
 from .client_relay_node import ClientRelayNode
 from .local_clipboard import LocalClipboard
 from .relay import Relay
+from .rooms import OneRoom
 from .server import Server
 from .settings import AppSettings
 from .ui import SettingsWindow
@@ -66,17 +67,18 @@ class DesktopApp:
 
         if settings.is_server_enabled and not self._server:
             self._server = Server(settings.server_listen_ip,
-                                  settings.server_listen_port, self._relay)
-            logger.debug(f'starting server {self._server}')
+                                  settings.server_listen_port,
+                                  OneRoom(self._relay))
+            logger.debug('starting server %s', self._server)
             self._server.start()
 
         if ((not settings.is_client_enabled) or
             (self._client and self._client.ws_url != settings.client_ws_url)):
-            logger.debug(f'stopping the client')
+            logger.debug('stopping the client')
             self._stop_client_if_running()
 
         if settings.is_client_enabled and not self._client:
-            logger.debug(f'starting client')
+            logger.debug('starting client')
             self._client = Client(settings.client_ws_url, self._relay)
             self._client.connect()
 
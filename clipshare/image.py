@@ -1,33 +1,290 @@
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+import os
+import time
+
 from PIL import Image
 
 from . import log
+from . import throughput
+from . import tracing
 
 
 logger = log.get_logger(__name__)
 
 
-# os x sends tiffs, and if we set a TIFF into the linux clipboard, it pretty
-# much works. except google chrome can't paste it. and i need to paste into
-# google chrome. so let's just do this conversion here. the cool thing is that
-# PNGs seem to be way smaller than TIFFs, so we'll just do the same conversion
-# on the os x side
-def change_tiff_to_png(clipboard_contents):
-    if clipboard_contents and 'image/tiff' in clipboard_contents:
-        tiff_data = clipboard_contents.pop('image/tiff')
-        clipboard_contents['image/png'] = convert_to_png(tiff_data)
+# decoding and encoding a big screenshot takes hundreds of milliseconds, which
+# is way too long to hold up the event loop, and with it the websocket
+# keepalives and the UI. PIL releases the GIL while it works, so threads are
+# enough to get it out of the way
+_executor = ThreadPoolExecutor(max_workers=2,
+                               thread_name_prefix='clipshare-image')
+
+
+# google chrome can only paste PNGs. anything else coming in from the other
+# side gets converted to PNG before it goes on the clipboard
+PASTEABLE_MIME_TYPE = 'image/png'
+IMAGE_MIME_TYPES = {'image/png', 'image/jpeg', 'image/tiff', 'image/webp'}
+
+
+# images at least this big get a preview sent ahead of them, if progressive
+# images are turned on
+PREVIEW_MIN_IMAGE_BYTES = 1_000_000
+PREVIEW_MAX_SIDE = 640
+
+
+# stats for an encoder, per pixel of the image. the initial guesses come from
+# encoding a 2560x1440 screenshot, and get replaced with real measurements as
+# images get encoded
+EncoderStats = namedtuple('EncoderStats', 'seconds_per_pixel bytes_per_pixel')
+STATS_SMOOTHING = 0.3
+# what it costs the receiver to convert anything that isn't a PNG
+PASTEABLE_CONVERSION_SECONDS_PER_PIXEL = 90e-9
+
+
+class PngEncoder:
+
+    mime_type = 'image/png'
+
+    def __init__(self, compress_level, initial_stats):
+        self.name = f'png-{compress_level}'
+        self.initial_stats = initial_stats
+        self._compress_level = compress_level
+
+    def encode(self, image_bytes, mime_type):
+        return self.mime_type, _save(image_bytes, 'PNG',
+                                     compress_level=self._compress_level)
+
+
+class WebpEncoder:
+
+    name = 'webp'
+    mime_type = 'image/webp'
+    initial_stats = EncoderStats(seconds_per_pixel=130e-9,
+                                 bytes_per_pixel=0.2)
+
+    def encode(self, image_bytes, mime_type):
+        return self.mime_type, _save(image_bytes, 'WEBP', lossless=True,
+                                     quality=50, method=4)
+
+
+# sends the image exactly the way it came off the clipboard
+class PassThroughEncoder:
+
+    name = 'passthrough'
+    mime_type = None
+    initial_stats = None
+
+    def encode(self, image_bytes, mime_type):
+        return mime_type, image_bytes
+
+
+ENCODERS = [
+    PngEncoder(1, EncoderStats(seconds_per_pixel=80e-9, bytes_per_pixel=0.45)),
+    PngEncoder(6, EncoderStats(seconds_per_pixel=110e-9, bytes_per_pixel=0.42)),
+    PngEncoder(9, EncoderStats(seconds_per_pixel=400e-9, bytes_per_pixel=0.41)),
+    WebpEncoder(),
+    PassThroughEncoder(),
+]
+ENCODER_BY_NAME = {encoder.name: encoder for encoder in ENCODERS}
+
+# either the name of one of the encoders, to always use that one, or auto
+ENCODER_SETTING = os.environ.get('CLIPSHARE_IMAGE_ENCODER', 'auto')
+if ENCODER_SETTING != 'auto' and ENCODER_SETTING not in ENCODER_BY_NAME:
+    logger.warning('unknown CLIPSHARE_IMAGE_ENCODER %r, expected auto or one '
+                   'of %s. falling back to auto', ENCODER_SETTING,
+                   ', '.join(ENCODER_BY_NAME))
+    ENCODER_SETTING = 'auto'
+
+
+# picks whichever encoder gets the image pasteable on the other side the
+# soonest: the time it takes to encode, plus the time it takes to send at the
+# throughput we've been seeing, plus the time it takes the other side to
+# convert it to something pasteable. on a fast link, it's not worth spending
+# time squeezing the image down. on a slow one, it is
+class EncoderChooser:
+
+    def __init__(self, encoders, *, throughput_estimator):
+        self._encoders = encoders
+        self._throughput_estimator = throughput_estimator
+        self._stats_by_encoder = {encoder: encoder.initial_stats
+                                  for encoder in encoders}
+
+    def choose(self, num_pixels, image_bytes, mime_type):
+        return min(self._encoders, key=lambda encoder: self.estimated_seconds(
+            encoder, num_pixels, image_bytes, mime_type))
+
+    def estimated_seconds(self, encoder, num_pixels, image_bytes, mime_type):
+        stats = self._stats_by_encoder[encoder]
+        if stats:
+            encode_seconds = stats.seconds_per_pixel * num_pixels
+            num_bytes = stats.bytes_per_pixel * num_pixels
+        else:
+            encode_seconds = 0
+            num_bytes = len(image_bytes)
+        output_mime_type = encoder.mime_type or mime_type
+        conversion_seconds = (
+            0 if output_mime_type == PASTEABLE_MIME_TYPE else
+            PASTEABLE_CONVERSION_SECONDS_PER_PIXEL * num_pixels)
+        return (encode_seconds +
+                self._throughput_estimator.seconds_to_send(num_bytes) +
+                conversion_seconds)
 
+    def record(self, encoder, num_pixels, seconds, num_bytes):
+        stats = self._stats_by_encoder[encoder]
+        if not stats or not num_pixels:
+            return
+        self._stats_by_encoder[encoder] = EncoderStats(
+            seconds_per_pixel=_smooth(stats.seconds_per_pixel,
+                                      seconds / num_pixels),
+            bytes_per_pixel=_smooth(stats.bytes_per_pixel,
+                                    num_bytes / num_pixels))
 
-def convert_to_png(image_bytes):
+
+def _smooth(previous, measured):
+    return STATS_SMOOTHING * measured + (1 - STATS_SMOOTHING) * previous
+
+
+encoder_chooser = EncoderChooser(ENCODERS,
+                                 throughput_estimator=throughput.outgoing)
+
+
+# re-encodes the image in freshly copied clipboard contents, before sending
+# them to the other side.
+#
+# returns the new contents. the contents passed in are left alone, so
+# cancelling halfway through doesn't leave them without an image
+async def encode_for_sending(clipboard_contents, *, trace_id=None):
+    mime_type = _find_image_type(clipboard_contents)
+    if not mime_type:
+        return clipboard_contents
+    image_bytes = clipboard_contents[mime_type]
+    # only reads the header, so it's quick enough to do right here
+    width, height = Image.open(BytesIO(image_bytes)).size
+    num_pixels = width * height
+
+    if ENCODER_SETTING == 'auto':
+        encoder = encoder_chooser.choose(num_pixels, image_bytes, mime_type)
+    else:
+        encoder = ENCODER_BY_NAME[ENCODER_SETTING]
+    started_at = time.perf_counter()
+    with tracing.span(trace_id, 'encode', encoder=encoder.name):
+        encoded_mime_type, encoded_bytes = await _run_in_executor(
+            encoder.encode, image_bytes, mime_type)
+    seconds = time.perf_counter() - started_at
+    encoder_chooser.record(encoder, num_pixels, seconds, len(encoded_bytes))
+
+    logger.debug('encoded a %dx%d %s with %s: %d bytes in, %d bytes out, '
+                 'took %.0fms', width, height, mime_type, encoder.name,
+                 len(image_bytes), len(encoded_bytes), seconds * 1000)
+    return _with_image(clipboard_contents, mime_type, encoded_mime_type,
+                       encoded_bytes)
+
+
+# converts an image that came in from the other side to something that can be
+# pasted anywhere. that's only ever for putting it on the local clipboard, so
+# go for speed over size. os x sends tiffs, and if we set a TIFF into the
+# linux clipboard, it pretty much works. except google chrome can't paste it.
+# and i need to paste into google chrome.
+#
+# an image that won't convert, like a corrupt one, is left the way it came
+# in. some apps might still be able to paste it
+async def make_pasteable(clipboard_contents):
+    mime_type = _find_image_type(clipboard_contents)
+    if not mime_type or mime_type == PASTEABLE_MIME_TYPE:
+        return clipboard_contents
+    try:
+        png_data = await convert_to_png(clipboard_contents[mime_type])
+    except Exception as e:
+        logger.warning("couldn't convert the %s to %s, leaving it as is: %r",
+                       mime_type, PASTEABLE_MIME_TYPE, e)
+        return clipboard_contents
+    return _with_image(clipboard_contents, mime_type, PASTEABLE_MIME_TYPE,
+                       png_data)
+
+
+# a downscaled copy of the image in clipboard contents, small enough to send
+# right away while the full image is still on its way
+async def make_preview(clipboard_contents):
+    mime_type = _find_image_type(clipboard_contents)
+    preview_bytes = await _run_in_executor(
+        make_preview_blocking, clipboard_contents[mime_type])
+    return _with_image(clipboard_contents, mime_type, PASTEABLE_MIME_TYPE,
+                       preview_bytes)
+
+
+def make_preview_blocking(image_bytes):
+    image = Image.open(BytesIO(image_bytes))
+    image.thumbnail((PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE))
     out = BytesIO()
+    image.save(out, 'PNG', compress_level=6)
+    logger.debug('made a %dx%d preview, %d bytes', image.width,
+                 image.height, out.getbuffer().nbytes)
+    return out.getvalue()
+
 
-    i = Image.open(BytesIO(image_bytes))
-    i.save(out, 'PNG')
+def is_worth_previewing(clipboard_contents):
+    mime_type = _find_image_type(clipboard_contents)
+    return (mime_type is not None and
+            len(clipboard_contents[mime_type]) >= PREVIEW_MIN_IMAGE_BYTES)
 
-    out.seek(0)
-    output = out.read()
 
-    logger.debug('to png converstion stats: '
-                 f'length of input: {len(image_bytes)} '
-                 f'length of output: {len(output)} ')
+# cancelling this before a worker picks up the conversion means it never runs
+# at all. once it's started, the worker finishes it, but the result is thrown
+# away
+async def convert_to_png(image_bytes, compress_level=1):
+    return await _run_in_executor(convert_to_png_blocking, image_bytes,
+                                  compress_level)
+
+
+def convert_to_png_blocking(image_bytes, compress_level=1):
+    output = _save(image_bytes, 'PNG', compress_level=compress_level)
+    logger.debug('to png converstion stats: length of input: %d length of '
+                 'output: %d', len(image_bytes), len(output))
     return output
+
+
+def _save(image_bytes, format, **params):
+    out = BytesIO()
+    Image.open(BytesIO(image_bytes)).save(out, format, **params)
+    return out.getvalue()
+
+
+async def _run_in_executor(func, *args):
+    return await asyncio.get_event_loop().run_in_executor(
+        _executor, func, *args)
+
+
+def _find_image_type(clipboard_contents):
+    if not clipboard_contents:
+        return None
+    return next((mime_type for mime_type in clipboard_contents
+                 if mime_type in IMAGE_MIME_TYPES), None)
+
+
+def _with_image(clipboard_contents, old_mime_type, new_mime_type, image_bytes):
+    new_contents = {mime_type: data for mime_type, data
+                    in clipboard_contents.items() if mime_type != old_mime_type}
+    new_contents[new_mime_type] = image_bytes
+    return new_contents
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python -m clipshare.image <image file> [bytes per second]
+    image_bytes = open(sys.argv[1], 'rb').read()
+    if len(sys.argv) > 2:
+        throughput.outgoing.bytes_per_second = int(sys.argv[2])
+    width, height = Image.open(BytesIO(image_bytes)).size
+    mime_type = Image.MIME[Image.open(BytesIO(image_bytes)).format]
+    print(f'{width}x{height} {mime_type} at '
+          f'{throughput.outgoing.bytes_per_second} bytes per second')
+    for encoder in ENCODERS:
+        estimate = encoder_chooser.estimated_seconds(
+            encoder, width * height, image_bytes, mime_type)
+        print(f'{encoder.name}: estimated {estimate * 1000:.0f}ms')
+    print('chose', encoder_chooser.choose(width * height, image_bytes,
+                                          mime_type).name)
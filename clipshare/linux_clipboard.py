@@ -1,18 +1,33 @@
+import asyncio
 import contextlib
+import hashlib
+import os
+import time
 
 from asyncblink import AsyncSignal
 from PyQt5.QtCore import QBuffer
 from PyQt5.QtCore import QByteArray
+from PyQt5.QtCore import QEventLoop
 from PyQt5.QtCore import QIODevice
 from PyQt5.QtCore import QMimeData
 
 from . import log
-from .image import change_tiff_to_png
+from . import tracing
+from .image import IMAGE_MIME_TYPES
+from .image import PASTEABLE_MIME_TYPE
+from .image import encode_for_sending
+from .image import make_pasteable
 
 
 logger = log.getLogger(__name__)
 
 
+# lots of apps change the clipboard several times for a single copy. wait for
+# it to stay the same for this long before grabbing what's on it
+QUIET_WINDOW_SECONDS = float(os.environ.get('CLIPSHARE_CLIPBOARD_QUIET_SECONDS',
+                                            0.1))
+
+
 # TODO: rename this to QtClipboard? maybe it works with windows :P
 class LinuxClipboard:
 
@@ -23,39 +38,119 @@ class LinuxClipboard:
     def __init__(self, qt_clipboard):
         self.new_clipboard_contents_signal = AsyncSignal()
         self._qt_clipboard = qt_clipboard
+        self._pending_set = None
+        self._encoding = None
+        self._pending_grab = None
+        self._last_grabbed_digest = None
 
-    def set(self, clipboard_contents):
-        with self._stop_receiving_clipboard_updates():
-            change_tiff_to_png(clipboard_contents)
-            qmimedata_to_set = QMimeDataSerializer.deserialize(clipboard_contents)
-            self._qt_clipboard.setMimeData(qmimedata_to_set)
+    # images might have to be converted first, which happens in the
+    # background. whatever gets set or cleared next replaces the contents
+    # we were still converting
+    def set(self, clipboard_contents, *, trace_id=None):
+        self._cancel_pending_set()
+        self._pending_set = asyncio.ensure_future(
+            self._convert_and_set(clipboard_contents, trace_id))
 
     def clear(self):
+        self._cancel_pending_set()
         with self._stop_receiving_clipboard_updates():
             self._qt_clipboard.clear()
 
+    async def _convert_and_set(self, clipboard_contents, trace_id):
+        with tracing.span(trace_id, 'set'):
+            clipboard_contents = await make_pasteable(clipboard_contents)
+            with self._stop_receiving_clipboard_updates():
+                qmimedata_to_set = QMimeDataSerializer.deserialize(
+                    clipboard_contents)
+                self._qt_clipboard.setMimeData(qmimedata_to_set)
+
+    # puts contents on the clipboard that haven't been fetched yet. fetch is
+    # a coroutine function returning the contents, and only gets called once
+    # something actually gets pasted
+    def set_lazy(self, mime_types, fetch):
+        self._cancel_pending_set()
+        with self._stop_receiving_clipboard_updates():
+            self._qt_clipboard.setMimeData(LazyQMimeData(mime_types, fetch))
+
+    def _cancel_pending_set(self):
+        if self._pending_set:
+            self._pending_set.cancel()
+            self._pending_set = None
+
     def start_listening_for_changes(self):
-        self._qt_clipboard.dataChanged.connect(self._grab_and_signal_clipboard_data)
+        self._qt_clipboard.dataChanged.connect(self._grab_once_things_quiet_down)
 
     # temporarily stop listening to the clipboard while we set it, because we
     # don't want to detect our own updates
     @contextlib.contextmanager
     def _stop_receiving_clipboard_updates(self):
+        # whatever we were about to grab is about to be replaced
+        if self._pending_grab:
+            self._pending_grab.cancel()
+            self._pending_grab = None
+        # so is what we grabbed last. copying that again is a new copy
+        self._last_grabbed_digest = None
         try:
-            self._qt_clipboard.dataChanged.disconnect(self._grab_and_signal_clipboard_data)
+            self._qt_clipboard.dataChanged.disconnect(
+                self._grab_once_things_quiet_down)
             yield
         finally:
             self.start_listening_for_changes()
 
+    # every change pushes the grab back, so a burst of changes ends up as a
+    # single grab once the last one is done
+    def _grab_once_things_quiet_down(self):
+        if self._pending_grab:
+            self._pending_grab.cancel()
+        self._pending_grab = asyncio.get_event_loop().call_later(
+            QUIET_WINDOW_SECONDS, self._grab_and_signal_clipboard_data)
+
     def _grab_and_signal_clipboard_data(self):
+        self._pending_grab = None
+        started_at = time.time()
         mime_data = self._qt_clipboard.mimeData()
+        # getting the contents out of qt can mean a transfer from another app
+        # and decoding an image, so it's only done the once
         clipboard_contents = QMimeDataSerializer.serialize(mime_data)
-        logger.debug(f'detected change {log.format_obj(clipboard_contents)}')
+        # apps also like to put the exact same thing on the clipboard again.
+        # the digest is cheap compared to encoding and sending
+        digest = QMimeDataSerializer.digest(clipboard_contents)
+        if digest == self._last_grabbed_digest:
+            logger.debug('clipboard contents are the same as last time, '
+                         'backing out')
+            return
+        self._last_grabbed_digest = digest
+        logger.debug('detected change %s', log.format_obj(clipboard_contents))
         if self._contains_data(clipboard_contents):
-            self.new_clipboard_contents_signal.send(clipboard_contents)
+            trace_id = tracing.new_trace_id()
+            tracing.record(trace_id, 'capture', started_at=started_at,
+                           seconds=time.time() - started_at)
+            self._signal(clipboard_contents,
+                         needs_encoding=QMimeDataSerializer.needs_encoding(
+                             mime_data),
+                         trace_id=trace_id)
         else:
             logger.debug('nothing to update, backing out')
 
+    # if something else gets copied while the image is still being encoded,
+    # the encoding is no longer worth finishing
+    def _signal(self, clipboard_contents, *, needs_encoding, trace_id):
+        if self._encoding:
+            self._encoding.cancel()
+            self._encoding = None
+        if needs_encoding:
+            self._encoding = asyncio.ensure_future(
+                self._encode_and_signal(clipboard_contents, trace_id))
+        else:
+            self.new_clipboard_contents_signal.send(clipboard_contents,
+                                                    trace_id=trace_id)
+
+    async def _encode_and_signal(self, clipboard_contents, trace_id):
+        clipboard_contents = await encode_for_sending(clipboard_contents,
+                                                      trace_id=trace_id)
+        self.new_clipboard_contents_signal.send(clipboard_contents,
+                                                trace_id=trace_id)
+
     def _contains_data(self, clipboard_contents):
         return any(clipboard_contents.values())
 
@@ -66,17 +161,48 @@ class LinuxClipboard:
 class QMimeDataSerializer:
 
     WORKING_NON_IMAGE_FORMATS = set(['text/plain'])
+    # in order of preference. most apps that copy an image offer it already
+    # encoded in one of these, and those bytes can be sent along untouched
+    NATIVE_IMAGE_FORMATS = ['image/png', 'image/jpeg']
 
     @classmethod
     def serialize(cls, qmimedata):
+        native_image_format = cls._native_image_format(qmimedata)
+        if native_image_format:
+            return {native_image_format:
+                    qmimedata.data(native_image_format).data()}
         if qmimedata.hasImage():
-            # TODO: see if this can be something other than png. i think it'll suck
-            # to send huge jpegs over the wire as png
+            # this PNG is uncompressed, so it's quick to get out of qt. the
+            # image gets properly encoded for sending in the background
             return {'image/png': cls._extract_image(qmimedata)}
         formats = qmimedata.formats()
         compatible_formats = cls.WORKING_NON_IMAGE_FORMATS.intersection(formats)
         return {format: qmimedata.data(format).data() for format in compatible_formats}
 
+    # whether serialize had to pull the image out of qt, rather than getting
+    # it already encoded
+    @classmethod
+    def needs_encoding(cls, qmimedata):
+        return (not cls._native_image_format(qmimedata) and
+                qmimedata.hasImage())
+
+    @classmethod
+    def _native_image_format(cls, qmimedata):
+        formats = qmimedata.formats()
+        return next((format for format in cls.NATIVE_IMAGE_FORMATS
+                     if format in formats), None)
+
+    # digests serialized contents. unlike the payload's digest, this doesn't
+    # have to pickle them first
+    @classmethod
+    def digest(cls, serialized):
+        hasher = hashlib.blake2b(digest_size=16)
+        for format in sorted(serialized):
+            hasher.update(format.encode())
+            hasher.update(len(serialized[format]).to_bytes(8, 'big'))
+            hasher.update(serialized[format])
+        return hasher.digest()
+
     @classmethod
     def deserialize(cls, serialized):
         qmimedata = QMimeData()
@@ -92,10 +218,63 @@ class QMimeDataSerializer:
         image_data = qmimedata.imageData()
         if not image_data:
             raise ClipboardHadNoImageError(qmimedata)
-        image_data.save(buffer, 'PNG')
+        # quality 100 is qt for zlib compression level 0
+        image_data.save(buffer, 'PNG', 100)
         return ba.data()
 
 
+class LazyQMimeData(QMimeData):
+    """QMimeData that only fetches its contents when they're asked for.
+
+    Qt calls retrieveData when an application pastes, and expects the data
+    back right then and there. So this spins a nested Qt event loop, which
+    also keeps the asyncio event loop running on top of it, until the fetch
+    is done.
+    """
+
+    def __init__(self, mime_types, fetch):
+        super().__init__()
+        # whatever comes in gets converted to something pasteable
+        self._mime_types = [PASTEABLE_MIME_TYPE if mime_type in IMAGE_MIME_TYPES
+                            else mime_type for mime_type in mime_types]
+        self._fetch = fetch
+        self._contents = None
+
+    def formats(self):
+        return self._mime_types
+
+    def hasFormat(self, mime_type):
+        return mime_type in self._mime_types
+
+    def retrieveData(self, mime_type, preferred_type):
+        if mime_type not in self._mime_types:
+            return None
+        if self._contents is None:
+            self._contents = self._wait_for(self._fetch_pasteable())
+        if self._contents is None:
+            return QByteArray()
+        return QByteArray(self._contents.get(mime_type, b''))
+
+    # None if the contents couldn't be had. that doesn't get remembered, so
+    # pasting again tries fetching them again. an exception can't be let out
+    # of here, it'd end up in qt's hands
+    async def _fetch_pasteable(self):
+        try:
+            return await make_pasteable(await self._fetch())
+        except asyncio.TimeoutError:
+            logger.debug('fetching lazy clipboard contents timed out')
+        except Exception as e:
+            logger.warning("couldn't fetch lazy clipboard contents: %r", e)
+        return None
+
+    def _wait_for(self, coroutine):
+        future = asyncio.ensure_future(coroutine)
+        event_loop = QEventLoop()
+        future.add_done_callback(lambda _: event_loop.quit())
+        event_loop.exec_()
+        return future.result()
+
+
 class ClipboardHadNoImageError(Exception):
 
     def __init__(self, qmimedata):
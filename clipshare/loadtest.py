@@ -0,0 +1,191 @@
+"""Load test for the relay server, run with more and more worker processes.
+
+For each worker count, starts `python -m clipshare.server` with that many
+WORKERS, then fills it with rooms from several client processes. Every room
+has one device copying the same payload over and over, each copy as soon as
+the last one got to everybody, and some others receiving it. Devices are
+spread over the workers however the kernel likes, so most rooms have devices
+on several workers, and their messages go over the bus.
+
+Reports how many bytes per second got delivered, and how that compares to a
+single worker. The clients need cores too, so don't expect scaling past about
+half the cores of the machine.
+
+Whether the workers scale close to linearly hasn't been measured yet. It was
+only ever run on a single core machine, where the workers and the clients all
+fight over the one core. That's only good for checking that everything gets
+delivered, and what the hop over the bus costs: 296MB/s with one worker,
+204MB/s with two.
+
+    python -m clipshare.loadtest [--workers 1,2,4] [--rooms 64]
+                                 [--receivers 2] [--seconds 10]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import websockets
+
+from .chunked_sending import Chunk
+from .frames import HEADER
+from .frames import FRAME_SUBPROTOCOL
+from .frames import FrameCodec
+from .websocket import COMPRESSION
+from .websocket import MAX_PAYLOAD_SIZE
+
+
+PAYLOAD_SIZE = 1_000_000
+SPLIT_SIZE = 100_000
+WARM_UP_SECONDS = 2
+SERVER_START_TIMEOUT_SECONDS = 30
+
+
+def _default_worker_counts():
+    worker_counts = [1]
+    while worker_counts[-1] * 2 <= max(1, os.cpu_count() // 2):
+        worker_counts.append(worker_counts[-1] * 2)
+    return worker_counts
+
+
+# one device copying, and the rest receiving what it copies. frames are
+# built and read straight off the websockets, so the clients stay cheap
+class _Room:
+
+    def __init__(self, url, *, num_receivers):
+        self._url = url
+        self._num_receivers = num_receivers
+        self._codec = FrameCodec()
+        self._data = os.urandom(SPLIT_SIZE)
+        self._num_chunks = PAYLOAD_SIZE // SPLIT_SIZE
+        self._received = None
+        self.bytes_delivered = 0
+
+    async def run(self):
+        sender, *receivers = [
+            await websockets.connect(self._url, max_size=MAX_PAYLOAD_SIZE,
+                                     compression=COMPRESSION,
+                                     subprotocols=[FRAME_SUBPROTOCOL])
+            for _ in range(self._num_receivers + 1)]
+        for receiver in receivers:
+            asyncio.ensure_future(self._receive_forever(receiver))
+        # give the server a moment to put everybody in the room
+        await asyncio.sleep(0.5)
+        while True:
+            self._received = asyncio.Semaphore(0)
+            message_hash = random.getrandbits(63)
+            for index in range(self._num_chunks):
+                await sender.send(self._codec.encode(Chunk(
+                    chunk_index=index, total_chunks=self._num_chunks,
+                    data=self._data, message_hash=message_hash)))
+            for _ in receivers:
+                await self._received.acquire()
+
+    async def _receive_forever(self, receiver):
+        async for frame in receiver:
+            self.bytes_delivered += len(frame)
+            _, _, _, chunk_index, total_chunks = HEADER.unpack_from(frame)
+            if chunk_index == total_chunks - 1:
+                self._received.release()
+
+
+def _run_clients(url, num_rooms, num_receivers, seconds, results):
+    async def run():
+        rooms = [_Room(f'{url}/loadtest-{random.getrandbits(64):x}',
+                       num_receivers=num_receivers)
+                 for _ in range(num_rooms)]
+        for room in rooms:
+            asyncio.ensure_future(room.run())
+        await asyncio.sleep(WARM_UP_SECONDS)
+        bytes_before = sum(room.bytes_delivered for room in rooms)
+        await asyncio.sleep(seconds)
+        results.put(sum(room.bytes_delivered for room in rooms) -
+                    bytes_before)
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+def run(num_workers, *, rooms, receivers, seconds, client_processes):
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'clipshare.server'],
+        env=dict(os.environ, WORKERS=str(num_workers), PORT=str(port),
+                 BIND_HOST='127.0.0.1', CLIPSHARE_LOG_LEVEL='warning'))
+    try:
+        _wait_for_port(port)
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        clients = [context.Process(target=_run_clients, args=(
+                       f'ws://127.0.0.1:{port}',
+                       len(range(index, rooms, client_processes)),
+                       receivers, seconds, results))
+                   for index in range(client_processes)]
+        for client in clients:
+            client.start()
+        bytes_delivered = sum(results.get() for _ in clients)
+        for client in clients:
+            client.terminate()
+            client.join()
+        return bytes_delivered / seconds
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def _free_port():
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        return free_socket.getsockname()[1]
+
+
+def _wait_for_port(port):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT_SECONDS
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--workers', default=','.join(
+                            map(str, _default_worker_counts())),
+                        help='comma separated worker counts to try')
+    parser.add_argument('--rooms', type=int, default=64)
+    parser.add_argument('--receivers', type=int, default=2,
+                        help='devices receiving in each room')
+    parser.add_argument('--seconds', type=float, default=10,
+                        help='how long to measure each worker count for')
+    parser.add_argument('--client-processes', type=int,
+                        default=max(1, os.cpu_count() // 2))
+    args = parser.parse_args()
+
+    worker_counts = list(map(int, args.workers.split(',')))
+    if max(worker_counts) * 2 > os.cpu_count():
+        print(f'only {os.cpu_count()} cores for up to {max(worker_counts)} '
+              'workers and their clients. these numbers say nothing about how '
+              'the workers scale', file=sys.stderr, flush=True)
+    single_worker_bytes_per_second = None
+    for num_workers in worker_counts:
+        bytes_per_second = run(num_workers, rooms=args.rooms,
+                               receivers=args.receivers, seconds=args.seconds,
+                               client_processes=args.client_processes)
+        single_worker_bytes_per_second = (single_worker_bytes_per_second or
+                                          bytes_per_second / num_workers)
+        speedup = bytes_per_second / single_worker_bytes_per_second
+        print(f'{num_workers:>3} workers {bytes_per_second / 1e6:>9.1f}MB/s '
+              f'speedup {speedup:>5.2f}x '
+              f'efficiency {speedup / num_workers:>4.0%}', flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,10 @@
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import time
 
+from Quartz import CGEventSourceSecondsSinceLastEventType
+from Quartz import kCGAnyInputEventType
+from Quartz import kCGEventSourceStateCombinedSessionState
 from ScriptingBridge import NSArray
 from ScriptingBridge import NSImage
 from ScriptingBridge import NSPasteboard
@@ -12,19 +16,27 @@ from tenacity import stop_after_attempt
 from tenacity import wait_fixed
 
 from . import log
-from .image import change_tiff_to_png
+from . import tracing
+from .polling import AdaptivePollInterval
+from .image import encode_for_sending
+from .image import make_pasteable
 
 
 logger = log.getLogger(__name__)
 
 
-CLIPBOARD_POLL_INTERVAL_SECONDS = 0.5
 # this is a total stab in the dark. for some reason, sometimes reading an
 # image from the mac clipboard has a problem, where you copy something, and it
 # appears to return null data. i'm having trouble reproducing it. this is here
 # in the event that this actually works.
 NS_PASTEBOARD_RETRY_COUNT = 3
 
+# reading a big image off the pasteboard can take a while, so it happens on
+# its own thread, away from the event loop. just the one, so reads don't
+# overlap
+_pasteboard_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='clipshare-pasteboard')
+
 
 class MacClipboard:
 
@@ -37,12 +49,30 @@ class MacClipboard:
         self.new_clipboard_contents_signal = AsyncSignal()
         self._ns_pasteboard = ns_pasteboard
         self._poller = Poller(self._ns_pasteboard)
-
-    def set(self, clipboard_contents):
+        self._conversion = None
+        self._pending_set = None
+
+    # images might have to be converted first, which happens in the
+    # background. whatever gets set or cleared next replaces the contents
+    # we were still converting
+    def set(self, clipboard_contents, *, trace_id=None):
+        self._cancel_pending_set()
+        self._pending_set = asyncio.ensure_future(
+            self._convert_and_set(clipboard_contents, trace_id))
+
+    async def _convert_and_set(self, clipboard_contents, trace_id):
+        with tracing.span(trace_id, 'set'):
+            self._set_now(await make_pasteable(clipboard_contents))
+
+    def _cancel_pending_set(self):
+        if self._pending_set:
+            self._pending_set.cancel()
+            self._pending_set = None
+
+    def _set_now(self, clipboard_contents):
         object_to_set = self._extract_settable_nsobject(clipboard_contents)
         if not object_to_set:
-            all_types = repr(clipboard_contents.keys())
-            logger.debug('unsupported clipboard payload ' +
+            logger.debug('unsupported clipboard payload %s',
                          log.format_obj(clipboard_contents))
             return
 
@@ -64,6 +94,7 @@ class MacClipboard:
             self._poller.resume_polling()
 
     def clear(self):
+        self._cancel_pending_set()
         logger.debug('clearing the clipboard')
         self._ns_pasteboard.clearContents()
 
@@ -71,14 +102,43 @@ class MacClipboard:
         asyncio.ensure_future(self._poll_forever())
 
     async def _poll_forever(self):
+        poll_interval = AdaptivePollInterval()
         while True:
-            t = time.time()
+            started_at = time.time()
             clipboard_contents = await self._poller.poll_for_new_clipboard_contents()
             if clipboard_contents:
-                logger.debug(f'detected change {self._poller.current_change_count} '
-                             + log.format_obj(clipboard_contents))
-                self.new_clipboard_contents_signal.send(clipboard_contents)
-            await asyncio.sleep(CLIPBOARD_POLL_INTERVAL_SECONDS)
+                trace_id = tracing.new_trace_id()
+                tracing.record(trace_id, 'capture', started_at=started_at,
+                               seconds=time.time() - started_at)
+                logger.debug('detected change %s %s',
+                             self._poller.current_change_count,
+                             log.format_obj(clipboard_contents))
+                self._signal(clipboard_contents, trace_id)
+            saw_activity = (bool(clipboard_contents) or
+                            seconds_since_user_input() < poll_interval.seconds)
+            await asyncio.sleep(
+                poll_interval.after_poll(saw_activity=saw_activity))
+
+    # PNGs and JPEGs go out exactly as they came off the pasteboard. only
+    # TIFFs, which are huge, get encoded first. keep polling while that
+    # happens. if something else gets copied in the meantime, the encoding
+    # that's still going is no longer worth finishing
+    def _signal(self, clipboard_contents, trace_id):
+        if self._conversion:
+            self._conversion.cancel()
+            self._conversion = None
+        if 'image/tiff' in clipboard_contents:
+            self._conversion = asyncio.ensure_future(
+                self._encode_and_signal(clipboard_contents, trace_id))
+        else:
+            self.new_clipboard_contents_signal.send(clipboard_contents,
+                                                    trace_id=trace_id)
+
+    async def _encode_and_signal(self, clipboard_contents, trace_id):
+        clipboard_contents = await encode_for_sending(clipboard_contents,
+                                                      trace_id=trace_id)
+        self.new_clipboard_contents_signal.send(clipboard_contents,
+                                                trace_id=trace_id)
 
     def _extract_settable_nsobject(self, clipboard_contents):
         image_type = self._find_image_type(clipboard_contents)
@@ -122,22 +182,29 @@ class Poller:
         if current_change_count == self._last_seen_change_count:
             return None
 
-        logger.debug(f'change count changed. '
-                     f'previously {self._last_seen_change_count}, now '
-                     f'{current_change_count}')
+        logger.debug('change count changed. previously %s, now %s',
+                     self._last_seen_change_count, current_change_count)
         self._last_seen_change_count = current_change_count
 
         # this logic prevents us from propagating our own clipboard updates.
         # immediately after setting the clipboard, we tell ourselves to ignore that
         # update
         if current_change_count == self._change_count_to_ignore:
-            logger.debug('ignoring the update we set ourselves: '
-                         f'{current_change_count}')
+            logger.debug('ignoring the update we set ourselves: %s',
+                         current_change_count)
             return None
 
-        extracted_contents = await extract_clipboard_contents(self._ns_pasteboard)
-        change_tiff_to_png(extracted_contents)
-        return extracted_contents
+        clipboard_contents = await extract_clipboard_contents(
+            self._ns_pasteboard)
+        # the read happens off the event loop, so remote contents might have
+        # been set while it was going. then there's no telling whose contents
+        # we read, and sending ours back out would echo them. whatever's on
+        # the pasteboard now gets picked up by the next poll
+        if self._paused or self.current_change_count != current_change_count:
+            logger.debug('the clipboard changed while reading it, dropping '
+                         'what was read')
+            return None
+        return clipboard_contents
 
     def pause_polling(self):
         self._paused = True
@@ -149,10 +216,16 @@ class Poller:
         self._change_count_to_ignore = change_count_to_ignore
 
 
-MIME_TYPE_BY_READABLE_TYPE = {'public.tiff': 'image/tiff',
+# in order of preference. apps that put an image on the pasteboard always
+# offer a TIFF, but a lot of them, like the screenshot tool, offer the PNG or
+# JPEG they already had too. those are way smaller, and can be sent along
+# without transcoding them
+MIME_TYPE_BY_READABLE_TYPE = {'public.png': 'image/png',
+                              'public.jpeg': 'image/jpeg',
+                              'public.tiff': 'image/tiff',
                               'public.utf8-plain-text': 'text/plain'}
 
-READABLE_TYPES = MIME_TYPE_BY_READABLE_TYPE.keys()
+READABLE_TYPES = list(MIME_TYPE_BY_READABLE_TYPE.keys())
 
 
 class NoReadableTypesError(Exception): pass
@@ -167,15 +240,27 @@ class NoDataError(Exception): pass
        wait=wait_fixed(0.1),
        retry_error_callback=lambda retry_state: None)
 async def extract_clipboard_contents(ns_pasteboard):
+    return await asyncio.get_event_loop().run_in_executor(
+        _pasteboard_executor, read_clipboard_contents, ns_pasteboard)
+
+
+def read_clipboard_contents(ns_pasteboard):
     data_type = ns_pasteboard.availableTypeFromArray_(READABLE_TYPES)
     mime_type = MIME_TYPE_BY_READABLE_TYPE.get(data_type)
     if not mime_type:
-        logger.debug(f"didn't find any readable types among: {list(ns_pasteboard.types())}")
+        logger.debug("didn't find any readable types among: %s",
+                     list(ns_pasteboard.types()))
         raise NoReadableTypesError
 
     ns_pasteboard_data = ns_pasteboard.dataForType_(data_type)
     if not ns_pasteboard_data:
-        logger.debug(f'failed querying NSPasteboard for type {mime_type}, '
-                     'retrying')
+        logger.debug('failed querying NSPasteboard for type %s, retrying',
+                     mime_type)
         raise NoDataError
     return {mime_type: bytes(ns_pasteboard_data)}
+
+
+# any keyboard or mouse input, from anywhere
+def seconds_since_user_input():
+    return CGEventSourceSecondsSinceLastEventType(
+        kCGEventSourceStateCombinedSessionState, kCGAnyInputEventType)
@@ -0,0 +1,120 @@
+import mmap
+import os
+import tempfile
+import weakref
+
+from . import log
+from . import metrics
+
+
+logger = log.getLogger(__name__)
+
+
+# a few big copies going at once can add up to more memory than the machine
+# has, and then the OOM killer comes along. big buffers for messages in
+# flight, like the serialized message on the way out, or the buffer a message
+# is reassembled in on the way in, are allocated here. chunks a relay holds
+# onto as they came in count towards the budget too. buffers are kept in
+# memory as long as the total stays under the budget. past that, they go into
+# temporary files instead, mmap'd, so the kernel can write them out to disk
+# and drop them from memory whenever it needs to.
+#
+# buffers at least MMAP_THRESHOLD_BYTES big are always mmaps, temporary file
+# or not. a bytearray has to be zeroed out all at once up front, while the
+# kernel hands out zeroed mmap pages only as they're written to. smaller
+# buffers are plain bytearrays, and don't count towards the budget
+MMAP_THRESHOLD_BYTES = 10_000_000
+DEFAULT_MAX_IN_MEMORY_BYTES = 512_000_000
+MAX_IN_MEMORY_BYTES = int(os.environ.get('CLIPSHARE_MAX_IN_MEMORY_BYTES',
+                                         DEFAULT_MAX_IN_MEMORY_BYTES))
+# where the temporary files go. the system's temporary directory by default
+SPILL_DIR = os.environ.get('CLIPSHARE_SPILL_DIR')
+
+
+class MemoryBudget:
+
+    def __init__(self, *, max_in_memory_bytes, spill_dir=None):
+        self.max_in_memory_bytes = max_in_memory_bytes
+        self.spill_dir = spill_dir
+        self.in_memory_bytes = 0
+        self.spilled_bytes = 0
+
+    # a zeroed out, writable buffer. it counts towards the budget until it's
+    # garbage collected, which is once nothing's using it, or any views of it
+    def allocate(self, size):
+        if size < MMAP_THRESHOLD_BYTES:
+            return bytearray(size)
+        if self.would_spill(size):
+            return self._allocate_spilled(size)
+        buffer = mmap.mmap(-1, size)
+        self.in_memory_bytes += size
+        weakref.finalize(buffer, self._release_in_memory, size)
+        self._update_metrics()
+        return buffer
+
+    # counts memory that's held onto some other way towards the budget, like
+    # the chunks of a message waiting around to be relayed along, until owner
+    # is garbage collected. calling the returned finalizer releases it early
+    def reserve(self, owner, size):
+        if size < MMAP_THRESHOLD_BYTES:
+            return lambda: None
+        self.in_memory_bytes += size
+        self._update_metrics()
+        return weakref.finalize(owner, self._release_in_memory, size)
+
+    def would_spill(self, size):
+        return (size >= MMAP_THRESHOLD_BYTES and
+                self.in_memory_bytes + size > self.max_in_memory_bytes)
+
+    def _allocate_spilled(self, size):
+        logger.debug('%d bytes of transfers in memory already, spilling %d '
+                     'bytes to disk', self.in_memory_bytes, size)
+        # the file is gone as soon as it's created. the mapping keeps the
+        # space on disk around until the buffer's garbage collected
+        with tempfile.TemporaryFile(dir=self.spill_dir) as file:
+            file.truncate(size)
+            buffer = mmap.mmap(file.fileno(), size)
+        self.spilled_bytes += size
+        weakref.finalize(buffer, self._release_spilled, size)
+        metrics.spills.inc()
+        self._update_metrics()
+        return buffer
+
+    def _release_in_memory(self, size):
+        self.in_memory_bytes -= size
+        self._update_metrics()
+
+    def _release_spilled(self, size):
+        self.spilled_bytes -= size
+        self._update_metrics()
+
+    def _update_metrics(self):
+        metrics.transfer_memory_bytes.set(self.in_memory_bytes)
+        metrics.spilled_bytes.set(self.spilled_bytes)
+
+
+budget = MemoryBudget(max_in_memory_bytes=MAX_IN_MEMORY_BYTES,
+                      spill_dir=SPILL_DIR)
+
+
+if __name__ == '__main__':
+    import time
+
+    size = 100_000_000
+    data = os.urandom(size)
+    for name, test_budget in [
+            ('in memory', MemoryBudget(max_in_memory_bytes=size)),
+            ('spilled', MemoryBudget(max_in_memory_bytes=0))]:
+        started_at = time.perf_counter()
+        buffer = test_budget.allocate(size)
+        memoryview(buffer)[:] = data
+        written_at = time.perf_counter()
+        assert memoryview(buffer) == data
+        read_at = time.perf_counter()
+        print(f'{name}: wrote {size} bytes in '
+              f'{(written_at - started_at) * 1000:.0f}ms, read them back in '
+              f'{(read_at - written_at) * 1000:.0f}ms. '
+              f'{test_budget.in_memory_bytes} in memory, '
+              f'{test_budget.spilled_bytes} spilled')
+        del buffer
+        assert test_budget.in_memory_bytes == test_budget.spilled_bytes == 0
@@ -0,0 +1,230 @@
+import asyncio
+import bisect
+
+from . import log
+
+
+logger = log.getLogger(__name__)
+
+
+# a tiny prometheus client. updating a metric is just bumping a number, so it's
+# cheap enough for the hot path, and everything else, like formatting, only
+# happens when somebody scrapes the endpoint.
+#
+# see https://prometheus.io/docs/instrumenting/exposition_formats/
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+REQUEST_TIMEOUT_SECONDS = 10
+
+_metrics = []
+
+
+class Counter:
+
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        _metrics.append(self)
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, {}, self.value
+
+
+class Gauge(Counter):
+
+    type = 'gauge'
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+# a gauge with one sample per label value, collected at scrape time. the
+# function returns a dict of label value to value
+class LabelledGauge:
+
+    type = 'gauge'
+
+    def __init__(self, name, help, *, label):
+        self.name = name
+        self.help = help
+        self._label = label
+        self._function = dict
+        _metrics.append(self)
+
+    def set_function(self, function):
+        self._function = function
+
+    def samples(self):
+        for label_value, value in self._function().items():
+            yield self.name, {self._label: label_value}, value
+
+
+class Histogram:
+
+    type = 'histogram'
+
+    def __init__(self, name, help, *, buckets):
+        self.name = name
+        self.help = help
+        self._buckets = sorted(buckets)
+        # the last one is for everything past the biggest bucket
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0
+        _metrics.append(self)
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+
+    def samples(self):
+        cumulative_count = 0
+        for bucket, count in zip(self._buckets, self._counts):
+            cumulative_count += count
+            yield f'{self.name}_bucket', {'le': _format_value(bucket)}, \
+                cumulative_count
+        cumulative_count += self._counts[-1]
+        yield f'{self.name}_bucket', {'le': '+Inf'}, cumulative_count
+        yield f'{self.name}_sum', {}, self._sum
+        yield f'{self.name}_count', {}, cumulative_count
+
+
+SECONDS_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60]
+BYTES_BUCKETS = [1024 * 4 ** i for i in range(8)]
+
+
+connections = Gauge('clipshare_connections',
+                    'Websocket connections currently open')
+connections_total = Counter('clipshare_connections_total',
+                            'Websocket connections accepted')
+rooms = Gauge('clipshare_rooms', 'Rooms with at least one node in them')
+snapshot_bytes = Gauge('clipshare_snapshot_bytes',
+                       'Bytes of latest clipboard snapshots kept for rooms')
+messages_received = Counter('clipshare_messages_received_total',
+                            'Messages the relay received from a node')
+messages_superseded = Counter(
+    'clipshare_messages_superseded_total',
+    'Messages dropped because something newer from the same origin came in')
+messages_sent = Counter('clipshare_messages_sent_total',
+                        'Messages handed to a node to send')
+messages_dropped = Counter(
+    'clipshare_messages_dropped_total',
+    "Messages dropped from a node's outbound queue before they were sent")
+chunks_received = Counter('clipshare_chunks_received_total',
+                          'Chunks received over websockets')
+chunks_sent = Counter('clipshare_chunks_sent_total',
+                      'Chunks sent over websockets')
+bytes_received = Counter('clipshare_bytes_received_total',
+                         'Bytes received over websockets')
+bytes_sent = Counter('clipshare_bytes_sent_total',
+                     'Bytes sent over websockets')
+chunk_bytes = Histogram('clipshare_chunk_bytes', 'Size of chunks sent',
+                        buckets=BYTES_BUCKETS)
+split_size_bytes = Histogram(
+    'clipshare_split_size_bytes',
+    'Chunk size chosen for a message, for the connection it went out on',
+    buckets=BYTES_BUCKETS)
+round_trip_seconds = Histogram('clipshare_round_trip_seconds',
+                               'Websocket ping round trip times',
+                               buckets=SECONDS_BUCKETS)
+fanout_seconds = Histogram(
+    'clipshare_fanout_seconds',
+    'Time from the relay receiving a message until every node it was meant '
+    'for is done with it',
+    buckets=SECONDS_BUCKETS)
+transfer_memory_bytes = Gauge(
+    'clipshare_transfer_memory_bytes',
+    'Bytes of big buffers for messages in flight, kept in memory')
+spilled_bytes = Gauge(
+    'clipshare_spilled_bytes',
+    'Bytes of big buffers for messages in flight, spilled to temporary files '
+    'because they went over the memory budget')
+spills = Counter('clipshare_spills_total',
+                 'Buffers for messages in flight spilled to temporary files')
+incoming_transfers = Gauge('clipshare_incoming_transfers',
+                           'Messages partway through being received')
+outgoing_transfers = Gauge('clipshare_outgoing_transfers',
+                           'Messages partway through being sent')
+node_queued_messages = LabelledGauge(
+    'clipshare_node_queued_messages',
+    "Messages waiting in a node's outbound queue", label='node')
+node_queued_bytes = LabelledGauge(
+    'clipshare_node_queued_bytes',
+    "Bytes waiting in a node's outbound queue, including the message being "
+    'sent', label='node')
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{_format_labels(labels)} '
+                         f'{_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"'
+                          for name, value in labels.items()) + '}'
+
+
+def _escape(label_value):
+    return (str(label_value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+# serves the metrics over plain http, at /metrics
+async def serve(bind_host, port):
+    server = await asyncio.start_server(_handle_request, bind_host, port)
+    logger.info('serving metrics on %s:%s/metrics', bind_host, port)
+    return server
+
+
+async def _handle_request(reader, writer):
+    try:
+        path = await asyncio.wait_for(_read_request_path(reader),
+                                      REQUEST_TIMEOUT_SECONDS)
+        if path == '/metrics':
+            status, content_type, body = '200 OK', CONTENT_TYPE, render()
+        else:
+            status, content_type, body = ('404 Not Found', 'text/plain',
+                                          'not found\n')
+        body = body.encode()
+        writer.write(f'HTTP/1.1 {status}\r\n'
+                     f'Content-Type: {content_type}\r\n'
+                     f'Content-Length: {len(body)}\r\n'
+                     'Connection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError, ValueError) as e:
+        logger.debug('bad metrics request: %r', e)
+    finally:
+        writer.close()
+
+
+async def _read_request_path(reader):
+    request_line = await reader.readline()
+    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    # nothing in the headers matters
+    while (await reader.readline()).strip():
+        pass
+    if method != 'GET':
+        return None
+    return target.split('?', 1)[0]
@@ -0,0 +1,172 @@
+from collections import deque
+from collections import namedtuple
+from collections import OrderedDict
+import copy
+
+from .chunked_sending import Message
+from .chunked_sending import MessageCancelledError
+from .delta import MissingBaseError
+from . import log
+from . import memory
+
+
+logger = log.getLogger(__name__)
+
+
+DEFAULT_MAX_CACHED_BYTES = 200_000_000
+
+
+CachedPayload = namedtuple('CachedPayload', 'serialized split_size')
+
+
+# recently relayed payloads, keyed by their content digest. before sending a
+# big message, we offer its digest to the other side first. if they've got it
+# in their cache, they can load it from there instead of having us send the
+# whole thing over again, like when flipping back and forth between two
+# copied images.
+#
+# on the server, every room only gets to see what was relayed in it, or
+# anybody could find out what's been copied in other rooms by offering
+# digests. rooms share one cache, and one limit on its size, but each looks
+# at it through its own PayloadCache (see for_room). everything else, like a
+# client, just uses the one for the default room.
+#
+# cached payloads are held onto in memory, so they count towards the memory
+# budget (see memory.py). the cache never takes up more than half of it, so
+# there's always room left for the transfers themselves
+class PayloadCache:
+
+    def __init__(self, *, max_bytes):
+        self._shared = _SharedPayloads(max_bytes)
+        self._room = ''
+
+    @property
+    def max_bytes(self):
+        return self._shared.max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes):
+        self._shared.max_bytes = max_bytes
+
+    def for_room(self, room):
+        room_cache = copy.copy(self)
+        room_cache._room = room
+        return room_cache
+
+    def __contains__(self, digest):
+        return (self._room, digest) in self._shared.payloads
+
+    # returns a new message with the cached content, to be relayed under the
+    # given metadata, or None if we don't have that content
+    def message_for(self, digest, *, metadata):
+        cached_payload = self._get(digest)
+        if not cached_payload:
+            return None
+        # the cache holds the content uncompressed and in full, however it
+        # was sent
+        metadata = {key: value for key, value in metadata.items()
+                    if key not in ('compression', 'delta')}
+        return Message.from_serialized(cached_payload.serialized,
+                                       split_size=cached_payload.split_size,
+                                       metadata=metadata)
+
+    def serialized_for(self, digest):
+        cached_payload = self._get(digest)
+        if not cached_payload:
+            return None
+        return cached_payload.serialized
+
+    # the previous version of the message's content from the same origin, if
+    # we've still got it, to send the message as a delta against
+    def base_for(self, metadata):
+        recent_digests = self._shared.recent_digests.get(
+            (self._room, metadata.get('origin')), ())
+        for digest in reversed(recent_digests):
+            if digest != metadata.get('digest') and digest in self:
+                return digest
+        return None
+
+    async def remember(self, message):
+        digest = message.metadata.get('digest')
+        if not digest:
+            # legacy clients don't send digests
+            return
+        if not self._is_worth_remembering(message):
+            return
+        if digest in self:
+            self._shared.payloads.move_to_end((self._room, digest))
+            self._remember_origin(message.metadata)
+            return
+
+        # wait for every chunk to come in before reassembling. until then,
+        # received chunks can be relayed along to other nodes untouched
+        async for _ in message.chunks:
+            pass
+        try:
+            serialized = await message.serialized
+        except MessageCancelledError:
+            return
+        except MissingBaseError as e:
+            logger.debug('not caching %r: %s', message, e)
+            return
+        self._shared.add((self._room, digest),
+                         CachedPayload(serialized, message.split_size))
+        self._remember_origin(message.metadata)
+
+    # only messages that get offered before they're sent are ever asked about
+    # (see RemoteRelayNode._offer), so there's no point reassembling and
+    # holding onto the rest. neither is there for anything too big to fit
+    def _is_worth_remembering(self, message):
+        return ((message.num_chunks > 1 or 'delta' in message.metadata) and
+                message.size <= self._shared.limit)
+
+    def _get(self, digest):
+        cached_payload = self._shared.payloads.get((self._room, digest))
+        if cached_payload:
+            self._shared.payloads.move_to_end((self._room, digest))
+        return cached_payload
+
+    def _remember_origin(self, metadata):
+        origin = metadata.get('origin')
+        if origin is None:
+            return
+        recent_digests = self._shared.recent_digests.setdefault(
+            (self._room, origin), deque(maxlen=2))
+        if metadata['digest'] in recent_digests:
+            recent_digests.remove(metadata['digest'])
+        recent_digests.append(metadata['digest'])
+
+
+# what every room's PayloadCache shares. payloads are keyed by (room, digest),
+# and so are the digests each origin sent last, by (room, origin)
+class _SharedPayloads:
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # least recently used first
+        self.payloads = OrderedDict()
+        self.total_bytes = 0
+        # the last couple of things each origin sent, newest last, to make
+        # deltas against
+        self.recent_digests = {}
+
+    @property
+    def limit(self):
+        return min(self.max_bytes, memory.budget.max_in_memory_bytes // 2)
+
+    def add(self, key, cached_payload):
+        size = len(cached_payload.serialized)
+        if size > self.limit or key in self.payloads:
+            return
+        self.payloads[key] = cached_payload
+        self.total_bytes += size
+        while self.total_bytes > self.limit:
+            (_, evicted_digest), evicted_payload = \
+                self.payloads.popitem(last=False)
+            self.total_bytes -= len(evicted_payload.serialized)
+            logger.debug('evicted %s from the payload cache', evicted_digest)
+        logger.debug('cached %s (%d bytes). payload cache now holds %d bytes',
+                     key[1], size, self.total_bytes)
+
+
+cache = PayloadCache(max_bytes=DEFAULT_MAX_CACHED_BYTES)
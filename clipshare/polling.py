@@ -0,0 +1,102 @@
+# the mac pasteboard has no change notifications, so it has to be polled.
+# polling at a fixed interval means picking between latency and wakeups:
+# every copy waits for up to a whole interval before it's noticed, and the
+# machine gets woken up just as often when nobody's using it.
+#
+# polling adaptively gets most of both. poll quickly right after the clipboard
+# changed or the user did something, since that's when another copy is
+# likely, and back off exponentially while things are quiet
+MIN_POLL_INTERVAL_SECONDS = 0.1
+MAX_POLL_INTERVAL_SECONDS = 2.0
+POLL_INTERVAL_BACKOFF = 1.5
+
+
+class AdaptivePollInterval:
+
+    def __init__(self, *, min_seconds=MIN_POLL_INTERVAL_SECONDS,
+                 max_seconds=MAX_POLL_INTERVAL_SECONDS,
+                 backoff=POLL_INTERVAL_BACKOFF):
+        self._min_seconds = min_seconds
+        self._max_seconds = max_seconds
+        self._backoff = backoff
+        self.seconds = min_seconds
+
+    # call after every poll. returns how long to wait until the next one
+    def after_poll(self, *, saw_activity):
+        if saw_activity:
+            self.seconds = self._min_seconds
+        else:
+            self.seconds = min(self.seconds * self._backoff, self._max_seconds)
+        return self.seconds
+
+
+class FixedPollInterval:
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def after_poll(self, *, saw_activity):
+        return self.seconds
+
+
+if __name__ == '__main__':
+    import random
+
+    # simulates an hour of somebody working: bursts of activity, like typing
+    # or moving the mouse around while selecting something, with a copy at the
+    # end of some of them, and idle stretches in between. time is simulated,
+    # so this runs instantly, and every strategy sees the exact same hour
+    SIMULATED_SECONDS = 60 * 60
+
+    def simulate_user(seed):
+        rng = random.Random(seed)
+        activity_times = []
+        copy_times = []
+        now = 0
+        while now < SIMULATED_SECONDS:
+            now += rng.expovariate(1 / 30)
+            burst_end = now + rng.uniform(0.5, 5)
+            while now < burst_end:
+                activity_times.append(now)
+                now += rng.expovariate(1 / 0.2)
+            if rng.random() < 0.5:
+                copy_times.append(now)
+                activity_times.append(now)
+        return activity_times, copy_times
+
+    def simulate_polling(poll_interval, activity_times, copy_times):
+        latencies = []
+        wakeups = 0
+        now = 0
+        last_poll = 0
+        next_copy_index = 0
+        next_activity_index = 0
+        while now < SIMULATED_SECONDS:
+            wakeups += 1
+            saw_activity = False
+            while (next_copy_index < len(copy_times) and
+                   copy_times[next_copy_index] <= now):
+                latencies.append(now - copy_times[next_copy_index])
+                next_copy_index += 1
+                saw_activity = True
+            while (next_activity_index < len(activity_times) and
+                   activity_times[next_activity_index] <= now):
+                if activity_times[next_activity_index] > last_poll:
+                    saw_activity = True
+                next_activity_index += 1
+            last_poll = now
+            now += poll_interval.after_poll(saw_activity=saw_activity)
+        return latencies, wakeups
+
+    activity_times, copy_times = simulate_user(seed=0)
+    print(f'{len(copy_times)} copies over {SIMULATED_SECONDS}s')
+    for name, poll_interval in [('fixed 0.5s', FixedPollInterval(0.5)),
+                                ('adaptive', AdaptivePollInterval())]:
+        latencies, wakeups = simulate_polling(poll_interval, activity_times,
+                                              copy_times)
+        latencies.sort()
+        mean = sum(latencies) / len(latencies)
+        p95 = latencies[int(len(latencies) * 0.95)]
+        print(f'{name}: mean latency {mean * 1000:.0f}ms, '
+              f'p95 {p95 * 1000:.0f}ms, {wakeups} wakeups '
+              f'({wakeups / SIMULATED_SECONDS:.2f}/s)')
@@ -1,17 +1,53 @@
 import asyncio
+import collections
 import contextlib
+import enum
 import functools
+import time
+import weakref
 
 from . import log
+from . import metrics
+from . import payload_cache
+from . import tracing
 
 
 logger = log.getLogger(__name__)
 
 
+# how many bytes worth of messages can pile up for a single node before its
+# overflow policy kicks in
+DEFAULT_MAX_QUEUED_BYTES = 100_000_000
+
+
+class OverflowPolicy(enum.Enum):
+    # wait for the node to catch up before queueing up more for it
+    BLOCK = 'block'
+    # throw away the oldest messages that haven't started sending yet. the
+    # clipboard only cares about the latest contents anyway
+    DROP_OLDEST = 'drop_oldest'
+    # give up on the node entirely
+    DISCONNECT = 'disconnect'
+
+
+DEFAULT_OVERFLOW_POLICY = OverflowPolicy.DROP_OLDEST
+
+
 class Relay:
 
-    def __init__(self):
+    # cache is the payload cache to remember relayed messages in (see
+    # payload_cache.py). the default room's, if not given
+    def __init__(self, *, max_queued_bytes=DEFAULT_MAX_QUEUED_BYTES,
+                 overflow_policy=DEFAULT_OVERFLOW_POLICY, cache=None):
+        self._max_queued_bytes = max_queued_bytes
+        self._overflow_policy = overflow_policy
+        self._cache = payload_cache.cache if cache is None else cache
         self._nodes = []
+        self._outbound_queues = {}
+        self._latest_version_by_origin = {}
+        # only hang onto the latest messages while something else is still
+        # using them, i.e. while they're being transferred
+        self._latest_message_by_origin = weakref.WeakValueDictionary()
 
     @contextlib.contextmanager
     def with_node(self, node):
@@ -27,24 +63,240 @@ class Relay:
             await self._relay_message_from_node(node, message)
         # TODO: make sure this weak=False doesn't cause a memory leak
         node.new_message_signal.connect(do_relay, weak=False)
+        self._outbound_queues[node] = OutboundQueue(
+            node, max_bytes=self._max_queued_bytes,
+            overflow_policy=self._overflow_policy)
+        self._outbound_queues[node].start()
         self._nodes.append(node)
-        logger.debug(f'added a node. all nodes now: {self._nodes}')
+        logger.debug('added a node. all nodes now: %s', self._nodes)
         node.start_relaying_changes()
 
     def _remove_node(self, node):
         self._nodes = self._get_nodes_other_than(node)
-        logger.debug(f'removed a node. all nodes now: {self._nodes}')
+        outbound_queue = self._outbound_queues.pop(node, None)
+        if outbound_queue:
+            outbound_queue.stop()
+        self._forget_origins_of(node)
+        logger.debug('removed a node. all nodes now: %s', self._nodes)
 
+    # otherwise every client that ever connected would keep an entry around.
+    # an origin's sequence numbers keep going up, so if it shows up again
+    # through another node, its next message is still the latest
+    def _forget_origins_of(self, node):
+        still_reachable = set().union(
+            *(other_node.origins for other_node in self._nodes))
+        for origin in node.origins - still_reachable:
+            self._latest_version_by_origin.pop(origin, None)
+
+    # every node has its own queue, and its own writer task draining it. so
+    # handing a message off to a slow node doesn't hold up the fast ones
     async def _relay_message_from_node(self, node, message):
+        received_at = time.perf_counter()
+        metrics.messages_received.inc()
         other_nodes = self._get_nodes_other_than(node)
-        logger.debug(f'received update from {repr(node)}: {log.format_obj(message)}')
-        futures = [self._send_message_to_node(node, message) for node in other_nodes]
-        await asyncio.gather(*futures)
+        logger.debug('received update from %r: %s', node, log.format_obj(message))
+        if not self._is_latest_from_its_origin(message):
+            logger.debug('already relayed something newer from the same '
+                         'origin, dropping %r', message)
+            metrics.messages_superseded.inc()
+            message.cancel()
+            return
+        asyncio.ensure_future(self._cache.remember(message))
+        futures = [self._outbound_queues[node].put(message)
+                   for node in self._destinations(message, other_nodes)
+                   if node in self._outbound_queues]
+        done_futures = [done for done in await asyncio.gather(*futures)
+                        if done]
+        if done_futures:
+            asyncio.ensure_future(
+                self._record_fanout_time(message, received_at, done_futures))
+
+    # messages are relayed along while they're still coming in, so this
+    # covers receiving them as well as sending them
+    async def _record_fanout_time(self, message, received_at, done_futures):
+        await asyncio.gather(*done_futures)
+        seconds = time.perf_counter() - received_at
+        metrics.fanout_seconds.observe(seconds)
+        tracing.record(tracing.trace_id_of(message.metadata), 'fanout',
+                       started_at=time.time() - seconds, seconds=seconds,
+                       destinations=len(done_futures))
 
-    async def _send_message_to_node(self, node, message):
-        logger.debug(f'sending update to {repr(node)}: {log.format_obj(message)}')
-        await node.accept_relayed_message(message)
-        logger.debug(f'done sending update to {repr(node)}')
+    # just for this one node, like catching it up on what it missed
+    async def send_to(self, node, message):
+        outbound_queue = self._outbound_queues.get(node)
+        if outbound_queue:
+            await outbound_queue.put(message)
+
+    def queued_messages_by_node(self):
+        return {repr(node): queue.num_queued_messages
+                for node, queue in self._outbound_queues.items()}
+
+    def queued_bytes_by_node(self):
+        return {repr(node): queue.queued_bytes
+                for node, queue in self._outbound_queues.items()}
+
+    # most messages go everywhere. some are meant for one origin in
+    # particular, like fetching lazy clipboard contents from where they were
+    # copied, so they only go towards the nodes that origin is behind
+    def _destinations(self, message, other_nodes):
+        destination_origin = message.metadata.get('to')
+        if destination_origin is None:
+            return other_nodes
+        destinations = [node for node in other_nodes
+                        if destination_origin in node.origins]
+        if not destinations:
+            logger.debug("don't know where %s is, dropping %r",
+                         destination_origin, message)
+        return destinations
+
+    # latest wins: a newer message from the same origin cancels the previous
+    # one, wherever it is. cancelling stops it from being split and sent, from
+    # being relayed along to other nodes, and from being received. messages
+    # from legacy clients don't say where they're from, so they always go.
+    #
+    # an image preview shares its sequence number with the full image. the
+    # full image is newer than the preview, but doesn't cancel it: the
+    # preview is what gets pasted until the full image comes in
+    def _is_latest_from_its_origin(self, message):
+        origin = message.metadata.get('origin')
+        sequence = message.metadata.get('sequence')
+        if origin is None or sequence is None:
+            return True
+
+        version = (sequence, not message.metadata.get('preview', False))
+        latest_version = self._latest_version_by_origin.get(origin)
+        if latest_version is not None and version <= latest_version:
+            return False
+
+        superseded_message = self._latest_message_by_origin.get(origin)
+        if (superseded_message and
+                superseded_message.metadata['sequence'] < sequence):
+            logger.debug('cancelling %r, superseded by %r',
+                         superseded_message, message)
+            superseded_message.cancel()
+        self._latest_version_by_origin[origin] = version
+        self._latest_message_by_origin[origin] = message
+        return True
 
     def _get_nodes_other_than(self, other_than_node):
         return [node for node in self._nodes if node != other_than_node]
+
+
+class OutboundQueue:
+
+    def __init__(self, node, *, max_bytes, overflow_policy):
+        self._node = node
+        self._max_bytes = max_bytes
+        self._overflow_policy = overflow_policy
+        # (message, size, done) for the messages that haven't started
+        # sending yet. done is a future that's resolved once the node is
+        # finished with the message, one way or another
+        self._pending = collections.deque()
+        # includes the message currently being sent
+        self._queued_bytes = 0
+        self._changed = asyncio.Condition()
+        self._writer_task = None
+        self._sending = None
+        self._gave_up_on_node = False
+
+    def start(self):
+        self._writer_task = asyncio.ensure_future(self._write_forever())
+
+    def stop(self):
+        self._writer_task.cancel()
+        for _, _, done in self._pending:
+            _resolve(done)
+
+    @property
+    def num_queued_messages(self):
+        return len(self._pending) + (1 if self._sending else 0)
+
+    @property
+    def queued_bytes(self):
+        return self._queued_bytes
+
+    # returns a future that's resolved once the node is finished with the
+    # message, or None if it's not going to get it at all
+    async def put(self, message):
+        if self._gave_up_on_node:
+            return None
+
+        size = message.size
+        async with self._changed:
+            if self._would_overflow(size):
+                logger.debug('outbound queue for %r is full (%d bytes), '
+                             'applying policy %s', self._node,
+                             self._queued_bytes, self._overflow_policy)
+                if self._overflow_policy == OverflowPolicy.BLOCK:
+                    await self._changed.wait_for(
+                        lambda: not self._would_overflow(size))
+                elif self._overflow_policy == OverflowPolicy.DROP_OLDEST:
+                    self._drop_oldest_until_fits(size)
+                elif self._overflow_policy == OverflowPolicy.DISCONNECT:
+                    self._give_up_on_node()
+                    return None
+
+            done = asyncio.Future()
+            self._pending.append((message, size, done))
+            self._queued_bytes += size
+            self._changed.notify_all()
+            return done
+
+    # a message bigger than the whole budget still gets sent once the queue is
+    # empty. otherwise it could never be sent at all
+    def _would_overflow(self, size):
+        return (self._queued_bytes > 0 and
+                self._queued_bytes + size > self._max_bytes)
+
+    def _drop_oldest_until_fits(self, size):
+        while self._pending and self._would_overflow(size):
+            dropped_message, dropped_size, done = self._pending.popleft()
+            self._queued_bytes -= dropped_size
+            _resolve(done)
+            metrics.messages_dropped.inc()
+            logger.debug('dropped %r bound for %r', dropped_message,
+                         self._node)
+
+    # the node gets removed from the relay once it's actually disconnected.
+    # until then, don't bother queueing anything else up for it
+    def _give_up_on_node(self):
+        self._gave_up_on_node = True
+        for _, size, done in self._pending:
+            self._queued_bytes -= size
+            _resolve(done)
+            metrics.messages_dropped.inc()
+        self._pending.clear()
+        self._node.disconnect()
+
+    async def _write_forever(self):
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: self._pending)
+                message, size, done = self._pending.popleft()
+                self._sending = message
+
+            try:
+                if message.is_cancelled:
+                    logger.debug('skipping %r, it was cancelled', message)
+                    continue
+                logger.debug('sending update to %r: %s', self._node,
+                             log.format_obj(message))
+                metrics.messages_sent.inc()
+                await self._node.accept_relayed_message(message)
+                logger.debug('done sending update to %r', self._node)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                # don't hang onto the message while waiting for the next one
+                self._sending = message = None
+                _resolve(done)
+                async with self._changed:
+                    self._queued_bytes -= size
+                    self._changed.notify_all()
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
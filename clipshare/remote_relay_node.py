@@ -1,49 +1,386 @@
 import asyncio
-import pickle
+from functools import partial
+import time
 
 from asyncblink import AsyncSignal
+import websockets
 
 from .chunked_receiving import ChunkedMessageReceiver
+from .chunked_sending import Message
+from .chunked_sending import MessageCancelledError
+from .compression import SUPPORTED_COMPRESSIONS
+from .compression import choose_compression
+from .compression import transcode_chunks
+from .delta import MAX_DELTA_BYTES
+from .delta import MissingBaseError
+from .delta import make_delta
+from .frames import Control
+from .frames import codec_for
 from . import log
+from . import metrics
+from . import payload_cache
 from . import signals
+from . import throughput
+from . import tracing
 from .transfer_progress import ProgressSignaler
 
 
 logger = log.getLogger(__name__)
 
 
+OFFER_REPLY_TIMEOUT_SECONDS = 5
+HELLO_TIMEOUT_SECONDS = 5
+# how often to ping the other side, to keep track of the round trip time
+ROUND_TRIP_INTERVAL_SECONDS = 10
+
+
 class RemoteRelayNode:
 
     # websocket is an instance from the websockets library
     #
     # see https://websockets.readthedocs.io/en/stable/api.html
-    def __init__(self, websocket):
+    #
+    # last_seen_digest is the digest of the last content that went either
+    # way over the previous connection to the same place, if any. cache is
+    # the payload cache for the room the connection's in (see
+    # payload_cache.py), or the default room's
+    def __init__(self, websocket, *, last_seen_digest=None, cache=None):
         self.new_message_signal = AsyncSignal()
+        self.last_seen_digest = last_seen_digest
         self._websocket = websocket
+        self._cache = payload_cache.cache if cache is None else cache
+        self._codec = codec_for(websocket)
         self._progress_signaler = ProgressSignaler(signals.outgoing_transfer)
+        # digest -> future that resolves to the other side's reply
+        self._pending_offers = {}
+        # filled in once the other side says hello. legacy peers never do, so
+        # they only ever get uncompressed messages
+        self._peer_compressions = []
+        self._peer_hello = asyncio.Future()
+        # every origin we've seen a message from on this connection, so the
+        # relay knows where to send messages meant for them
+        self.origins = set()
+        # messages that start out here are split up to suit this connection
+        self._throughput = throughput.ThroughputEstimator(
+            initial_bytes_per_second=throughput.outgoing.bytes_per_second)
+        self._chunk_sizer = throughput.ChunkSizer(self._throughput)
 
     async def accept_relayed_message(self, message):
-        self._progress_signaler.begin_transfer(message)
-        async for chunk in message.chunks:
-            await self._websocket.send(pickle.dumps(chunk))
-            self._progress_signaler.on_chunk_transferred()
+        if (not self._codec.supports_metadata and
+                _only_makes_sense_with_metadata(message)):
+            logger.debug("%r can't receive metadata, so there's no point "
+                         'sending it %r', self, message)
+            return
+        split_message = self._resplit(message)
+        trace_id = tracing.trace_id_of(message.metadata)
+        with tracing.span(trace_id, 'offer', node=repr(self)):
+            reply = await self._offer(split_message)
+        if reply and reply['type'] == 'have':
+            logger.debug('%r already has %r, skipping the transfer', self,
+                         message)
+            self._saw(message)
+            return
+        try:
+            message_to_send = await self._delta_or_full_message(
+                split_message, base=reply.get('base') if reply else None)
+        except MessageCancelledError:
+            return
+        except MissingBaseError as e:
+            # a delta that can't be rebuilt, for a peer that can't use it
+            logger.warning('not sending %r to %r: %s', message, self, e)
+            return
+
+        chunks, metadata = self._chunks_to_send(message_to_send)
+        metadata = tracing.stamp_sent_at(metadata)
+        self._progress_signaler.begin_transfer(message_to_send)
+        metrics.outgoing_transfers.inc()
+        try:
+            with throughput.measure(throughput.outgoing,
+                                    self._throughput) as measurement, \
+                    tracing.span(trace_id, 'send', node=repr(self)):
+                async for chunk in chunks:
+                    # the relay cancels the message it handed us, which might
+                    # not be the one we're sending
+                    if message.is_cancelled:
+                        break
+                    chunk_metadata = (metadata if chunk.is_the_first_chunk
+                                      else None)
+                    await self._send_frame(
+                        self._codec.encode(chunk, chunk_metadata))
+                    measurement.add(len(chunk.data))
+                    metrics.chunks_sent.inc()
+                    metrics.chunk_bytes.observe(len(chunk.data))
+                    self._progress_signaler.on_chunk_transferred()
+        finally:
+            metrics.outgoing_transfers.dec()
+        if message.is_cancelled:
+            self._progress_signaler.cancel_transfer()
+        else:
+            self._saw(message)
+
+    def _resplit(self, message):
+        split_size = self._chunk_sizer.split_size
+        split_message = message.resplit(split_size)
+        if split_message is not message:
+            metrics.split_size_bytes.observe(split_size)
+            logger.debug('splitting %r into %d byte chunks for %r: %.0f '
+                         'bytes per second, round trip %s', message,
+                         split_size, self, self._throughput.bytes_per_second,
+                         self._chunk_sizer.round_trip_seconds)
+        return split_message
+
+    # if the other side still has the previous version of this content, and a
+    # delta against it is smaller than the content, send the delta instead.
+    # deltas only make sense between two peers that agreed on the base, so a
+    # delta we received gets rebuilt into the full content for anybody else.
+    # only the node the message came from makes deltas. everybody else relays
+    # the message the way it came in
+    async def _delta_or_full_message(self, message, *, base):
+        delta = message.metadata.get('delta')
+        if delta and delta['base'] == base:
+            return message
+        if not delta and not (base and message.is_worth_sending_as_delta):
+            return message
+
+        serialized = await message.serialized
+        base_serialized = (self._cache.serialized_for(base)
+                           if message.is_worth_sending_as_delta else None)
+        if (base_serialized is not None and
+                len(base_serialized) <= MAX_DELTA_BYTES):
+            delta_message = await self._make_delta_message(
+                message, serialized, base=base,
+                base_serialized=base_serialized)
+            if delta_message:
+                return delta_message
+        return Message.from_serialized(
+            serialized, split_size=message.split_size,
+            metadata=_without(message.metadata, 'compression', 'delta'))
+
+    async def _make_delta_message(self, message, serialized, *, base,
+                                  base_serialized):
+        # cutting the content up into blocks takes a while for big payloads
+        delta = await asyncio.get_event_loop().run_in_executor(None, partial(
+            make_delta, base_serialized, serialized, base_digest=base,
+            target_digest=message.metadata['digest']))
+        if len(delta) >= len(serialized):
+            logger.debug('delta for %r is no smaller than the full content, '
+                         'sending it in full', message)
+            return None
+        logger.debug('sending %r as a %d byte delta instead of %d bytes',
+                     message, len(delta), len(serialized))
+        metadata = _without(message.metadata, 'compression')
+        metadata['delta'] = {'base': base, 'split_size': message.split_size}
+        return Message.from_serialized(delta, split_size=message.split_size,
+                                       metadata=metadata)
+
+    # compression is per message, and negotiated per connection. messages get
+    # compressed on their way out of the node they came from, if it looks like
+    # it'll pay off, and stay compressed all the way to the receiver. they're
+    # only decompressed in between for a peer that doesn't support whatever
+    # they were compressed with
+    def _chunks_to_send(self, message):
+        current_compression = message.metadata.get('compression')
+        if current_compression in self._peer_compressions:
+            compression = current_compression
+        elif not current_compression and message.is_worth_compressing:
+            compression = choose_compression(self._peer_compressions)
+        else:
+            compression = None
+
+        if compression == current_compression:
+            return message.chunks, message.metadata
+        metadata = _without(message.metadata, 'compression')
+        if compression:
+            metadata['compression'] = compression
+        chunks = transcode_chunks(message.chunks,
+                                  from_compression=current_compression,
+                                  to_compression=compression)
+        return chunks, metadata
+
+    # have/want negotiation: offer the digest of the content first, and only
+    # send the chunks over if the other side doesn't have the content cached.
+    # that costs a round trip, so don't bother for messages that fit in a
+    # single chunk anyway, unless they're deltas: the other side has to have
+    # the base for those. the offer also says which previous version of the
+    # content we could send a delta against, and the reply says whether the
+    # other side has it. returns the reply, if we got one
+    async def _offer(self, message):
+        digest = message.metadata.get('digest')
+        delta = message.metadata.get('delta')
+        if (not digest or not self._codec.supports_control_messages or
+                (message.num_chunks <= 1 and not delta)):
+            return None
+
+        if delta:
+            base = delta['base']
+        elif message.is_worth_sending_as_delta:
+            base = self._cache.base_for(message.metadata)
+        else:
+            base = None
+        reply = asyncio.Future()
+        self._pending_offers[digest] = reply
+        try:
+            await self._send_control(type='offer', metadata=message.metadata,
+                                     base=base)
+            return await asyncio.wait_for(reply, OFFER_REPLY_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.debug('%r never replied to the offer for %s, sending it '
+                         'anyway', self, digest)
+            return None
+        finally:
+            del self._pending_offers[digest]
+
+    async def _handle_control_message(self, control):
+        control_type = control.get('type')
+        if control_type == 'hello':
+            self._peer_compressions = control.get('compression', [])
+            if not self._peer_hello.done():
+                self._peer_hello.set_result(control)
+        elif control_type == 'offer':
+            await self._handle_offer(control['metadata'], control.get('base'))
+        elif control_type in ('have', 'want'):
+            reply = self._pending_offers.get(control['digest'])
+            if reply and not reply.done():
+                reply.set_result(control)
+        else:
+            logger.debug('ignoring unknown control message %s', control)
+
+    async def _handle_offer(self, metadata, base):
+        digest = metadata['digest']
+        message = self._cache.message_for(digest, metadata=metadata)
+        if not message:
+            # only tell the other side about the base if we've got it
+            base = base if base in self._cache else None
+            await self._send_control(type='want', digest=digest, base=base)
+            return
+        await self._send_control(type='have', digest=digest)
+        self._learn_origin(metadata)
+        self._saw(message)
+        # we've already got the content, so carry on as if the other side
+        # had just sent the whole message over
+        self.new_message_signal.send(message)
+
+    async def _send_control(self, **control):
+        await self._send_frame(self._codec.encode_control(control))
+
+    # a frame is either bytes, or a list of them that goes out as one
+    # fragmented message
+    async def _send_frame(self, frame):
+        await self._websocket.send(frame)
+        metrics.bytes_sent.inc(sum(map(len, frame)) if isinstance(frame, list)
+                               else len(frame))
+
+    def _learn_origin(self, metadata):
+        if metadata.get('origin'):
+            self.origins.add(metadata['origin'])
+
+    # messages meant for one device in particular, like fetches, aren't
+    # what's on the clipboard
+    def _saw(self, message):
+        if 'to' not in message.metadata and message.metadata.get('digest'):
+            self.last_seen_digest = message.metadata['digest']
+
+    # what the other side says it saw last, over its previous connection.
+    # None if it didn't say, or can't, because it's a legacy peer
+    async def peer_last_seen_digest(self):
+        if not self._codec.supports_control_messages:
+            return None
+        try:
+            hello = await asyncio.wait_for(asyncio.shield(self._peer_hello),
+                                           HELLO_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            return None
+        return hello.get('seen')
+
+    def disconnect(self):
+        asyncio.ensure_future(self._websocket.close())
 
     def start_relaying_changes(self):
+        if self._codec.supports_control_messages:
+            asyncio.ensure_future(self._send_control(
+                type='hello', compression=SUPPORTED_COMPRESSIONS,
+                seen=self.last_seen_digest))
         asyncio.ensure_future(self._process_messages())
+        asyncio.ensure_future(self._measure_round_trips_forever())
+
+    # a pong waits behind whatever's already on its way, so some of these
+    # include time spent queued up behind big transfers. the chunk sizer only
+    # goes by the lowest ones
+    async def _measure_round_trips_forever(self):
+        while True:
+            try:
+                started_at = time.perf_counter()
+                await (await self._websocket.ping())
+            except websockets.ConnectionClosed:
+                return
+            seconds = time.perf_counter() - started_at
+            self._chunk_sizer.record_round_trip(seconds)
+            metrics.round_trip_seconds.observe(seconds)
+            await asyncio.sleep(ROUND_TRIP_INTERVAL_SECONDS)
 
     async def _process_messages(self):
         async for message in self._chunked_message_receiver.received_messages:
+            self._learn_origin(message.metadata)
+            self._saw(message)
+            if tracing.trace_id_of(message.metadata):
+                self._trace_receiving(message)
             self.new_message_signal.send(message)
+            # don't hang onto it while waiting for the next one
+            del message
+
+    # the time in flight is measured across two machines' clocks, so it's
+    # only as good as they are in sync
+    def _trace_receiving(self, message):
+        trace_id = tracing.trace_id_of(message.metadata)
+        sent_at = tracing.sent_at(message.metadata)
+        now = time.time()
+        if sent_at:
+            tracing.record(trace_id, 'network', started_at=sent_at,
+                           seconds=now - sent_at, node=repr(self))
+        asyncio.ensure_future(self._trace_rest_of_message(message, now))
+
+    # from the first chunk coming in until the last one does
+    async def _trace_rest_of_message(self, message, first_chunk_at):
+        async for _ in message.chunks:
+            pass
+        if not message.is_cancelled:
+            tracing.record(tracing.trace_id_of(message.metadata), 'receive',
+                           started_at=first_chunk_at,
+                           seconds=time.time() - first_chunk_at,
+                           node=repr(self))
 
     @property
     def _chunked_message_receiver(self):
-        return ChunkedMessageReceiver(self._depickled_socket_messages)
+        return ChunkedMessageReceiver(self._decoded_socket_messages,
+                                      cache=self._cache)
 
     @property
-    async def _depickled_socket_messages(self):
+    async def _decoded_socket_messages(self):
         async for msg in self._websocket:
-            yield pickle.loads(msg)
+            metrics.bytes_received.inc(len(msg))
+            decoded = self._codec.decode(msg)
+            if isinstance(decoded, Control):
+                await self._handle_control_message(decoded)
+            else:
+                metrics.chunks_received.inc()
+                yield decoded
 
+    # the other end of the connection. on the server, host and port are the
+    # server's own, and would be the same for every node
+    # the websocket forgets where it was connected to once it's closed
     def __repr__(self):
-        return (f'<{type(self).__name__}: '
-                f'{self._websocket.host}:{self._websocket.port}>')
+        remote_address = self._websocket.remote_address
+        host, port = remote_address[:2] if remote_address else ('?', '?')
+        return f'<{type(self).__name__}: {host}:{port}>'
+
+
+# lazy clipboard manifests, and fetches of the contents behind them, are
+# nothing without their metadata. legacy peers can't receive metadata, so they
+# miss out on lazy copies
+def _only_makes_sense_with_metadata(message):
+    return any(key in message.metadata
+               for key in ('manifest', 'fetch', 'fetched'))
+
+
+def _without(metadata, *keys):
+    return {key: value for key, value in metadata.items() if key not in keys}
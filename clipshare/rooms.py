@@ -0,0 +1,140 @@
+import asyncio
+import contextlib
+from urllib.parse import urlsplit
+
+from . import log
+from . import metrics
+from . import payload_cache
+from .snapshots import SnapshotNode
+
+
+logger = log.getLogger(__name__)
+
+
+# devices only share clipboards with the other devices in their room. the room
+# is the path of the websocket url the device connected to, so
+# ws://example.com/some-long-random-token is its own room, and plain
+# ws://example.com is the room everybody's in who didn't pick one
+def room_for_path(path):
+    return urlsplit(path).path.strip('/')
+
+
+# a relay for every room that has somebody in it. a room's relay is made when
+# the first node joins, and thrown away when the last one leaves, so a message
+# only ever fans out to the nodes in its own room.
+#
+# when the server runs as several workers, every open room also gets a node
+# from the bus (see bus.py), for the devices in it on other workers. with a
+# snapshot store (see snapshots.py), every open room gets a node that keeps
+# its snapshot up to date, and devices get the snapshot as they join
+class Rooms:
+
+    # make_relay takes the room's payload cache as cache, and returns the
+    # relay for a new room
+    def __init__(self, make_relay, *, bus=None, snapshots=None):
+        self._make_relay = make_relay
+        self._bus = bus
+        self._snapshots = snapshots
+        self._rooms = {}
+
+    @contextlib.contextmanager
+    def with_node(self, room_name, node):
+        room = self._rooms.get(room_name)
+        if room is None:
+            room = self._rooms[room_name] = self._open(room_name)
+        room.num_nodes += 1
+        try:
+            with room.relay.with_node(node):
+                if self._snapshots:
+                    asyncio.ensure_future(
+                        self._send_snapshot(room_name, room, node))
+                yield
+        finally:
+            room.num_nodes -= 1
+            if not room.num_nodes and self._rooms.get(room_name) is room:
+                del self._rooms[room_name]
+                self._close(room)
+
+    def _open(self, room_name):
+        room = _Room(self._make_relay(
+            cache=self.payload_cache_for(room_name)))
+        if self._bus:
+            bus_node = self._bus.node_for(room_name)
+            room.other_nodes_context.enter_context(
+                room.relay.with_node(bus_node))
+            room.other_nodes_context.callback(bus_node.close)
+        if self._snapshots:
+            room.snapshot_node = SnapshotNode(self._snapshots, room_name)
+            room.other_nodes_context.enter_context(
+                room.relay.with_node(room.snapshot_node))
+        metrics.rooms.inc()
+        logger.debug('opened a room. %d rooms now', len(self._rooms) + 1)
+        return room
+
+    def _close(self, room):
+        room.other_nodes_context.close()
+        metrics.rooms.dec()
+        logger.debug('closed a room. %d rooms now', len(self._rooms))
+
+    # every room only gets to see the payloads relayed in it
+    def payload_cache_for(self, room_name):
+        return payload_cache.cache.for_room(room_name)
+
+    def queued_messages_by_node(self):
+        return _merged(room.relay.queued_messages_by_node()
+                       for room in self._rooms.values())
+
+    def queued_bytes_by_node(self):
+        return _merged(room.relay.queued_bytes_by_node()
+                       for room in self._rooms.values())
+
+    # once the node says what it's seen last, so it doesn't get sent what it
+    # already has. if somebody copied something in the meantime, the node's
+    # getting that anyway, and the snapshot's out of date
+    async def _send_snapshot(self, room_name, room, node):
+        num_messages_seen = room.snapshot_node.num_messages_seen
+        last_seen_digest = await node.peer_last_seen_digest()
+        if room.snapshot_node.num_messages_seen != num_messages_seen:
+            return
+        message = self._snapshots.message_for(room_name)
+        if not message or message.metadata.get('digest') == last_seen_digest:
+            return
+        logger.debug('sending %r the snapshot of its room', node)
+        await room.relay.send_to(node, message)
+
+
+class _Room:
+
+    def __init__(self, relay):
+        self.relay = relay
+        # not counting the bus or snapshot nodes
+        self.num_nodes = 0
+        self.snapshot_node = None
+        self.other_nodes_context = contextlib.ExitStack()
+
+
+# everybody's in the same room, whatever path they connected to. for the
+# desktop app, which serves its own clipboard's relay to the local network
+class OneRoom:
+
+    def __init__(self, relay):
+        self._relay = relay
+
+    def with_node(self, room, node):
+        return self._relay.with_node(node)
+
+    def payload_cache_for(self, room):
+        return payload_cache.cache
+
+    def queued_messages_by_node(self):
+        return self._relay.queued_messages_by_node()
+
+    def queued_bytes_by_node(self):
+        return self._relay.queued_bytes_by_node()
+
+
+def _merged(dicts):
+    merged = {}
+    for d in dicts:
+        merged.update(d)
+    return merged
@@ -1,11 +1,30 @@
 import asyncio
+import functools
+import multiprocessing
+import multiprocessing.connection
 import os
+import shutil
+import signal
+import sys
+import tempfile
 import websockets
 
+from .bus import Bus
+from .frames import SUBPROTOCOLS
 from . import log
+from . import metrics
+from . import payload_cache
 from . import signals
+from .relay import DEFAULT_MAX_QUEUED_BYTES
+from .relay import DEFAULT_OVERFLOW_POLICY
+from .relay import OverflowPolicy
 from .relay import Relay
 from .remote_relay_node import RemoteRelayNode
+from .rooms import Rooms
+from .rooms import room_for_path
+from .snapshots import DEFAULT_MAX_SNAPSHOT_BYTES
+from .snapshots import SnapshotStore
+from .websocket import COMPRESSION
 from .websocket import MAX_PAYLOAD_SIZE
 from .websocket import keepalive_forever
 
@@ -15,12 +34,20 @@ logger = log.get_logger(__name__)
 
 class Server:
 
-    def __init__(self, bind_host, port, relay):
+    # rooms decides which relay each connection goes into (see rooms.py).
+    # metrics are served over http on metrics_port, if it's given. with
+    # reuse_port, several processes can listen on the same port, and the
+    # kernel spreads the connections between them
+    def __init__(self, bind_host, port, rooms, *, metrics_port=None,
+                 reuse_port=False):
         self.bind_host = bind_host
         self.port = port
+        self.metrics_port = metrics_port
+        self.reuse_port = reuse_port
 
-        self._relay = relay
+        self._rooms = rooms
         self._server = None
+        self._metrics_server = None
 
     def start(self):
         if self._server:
@@ -30,6 +57,8 @@ class Server:
     def stop(self):
         if self.is_active:
             self._server.close()
+        if self._metrics_server:
+            self._metrics_server.close()
 
     @property
     def is_active(self):
@@ -38,20 +67,103 @@ class Server:
     async def _start_listening(self):
         self._server = await websockets.serve(self._handle_websocket,
                                               self.bind_host, self.port,
-                                              max_size=MAX_PAYLOAD_SIZE)
+                                              max_size=MAX_PAYLOAD_SIZE,
+                                              compression=COMPRESSION,
+                                              subprotocols=SUBPROTOCOLS,
+                                              reuse_port=self.reuse_port)
+        if self.metrics_port:
+            metrics.node_queued_messages.set_function(
+                self._rooms.queued_messages_by_node)
+            metrics.node_queued_bytes.set_function(
+                self._rooms.queued_bytes_by_node)
+            self._metrics_server = await metrics.serve(self.bind_host,
+                                                       self.metrics_port)
         signals.server_listening.send()
 
     async def _handle_websocket(self, websocket, path):
-        # this server doesn't look at the websocket url or path. it treats all
-        # incoming requests the same
-        with self._relay.with_node(RemoteRelayNode(websocket)):
-            await keepalive_forever(websocket)
+        metrics.connections.inc()
+        metrics.connections_total.inc()
+        try:
+            room = room_for_path(path)
+            node = RemoteRelayNode(
+                websocket, cache=self._rooms.payload_cache_for(room))
+            with self._rooms.with_node(room, node):
+                await keepalive_forever(websocket)
+        finally:
+            metrics.connections.dec()
 
 
-if __name__ == '__main__':
+# one asyncio process only ever uses one core. with WORKERS set to more than
+# 1 (or to auto, for one per core), the server runs as that many processes
+# instead, all listening on the same port. they pass messages between each
+# other over the bus (see bus.py), for rooms with devices on several workers.
+# every worker serves its own metrics, on METRICS_PORT plus its index
+def run_workers(num_workers):
+    socket_dir = tempfile.mkdtemp(prefix='clipshare-bus-')
+    # forking would copy over the logging thread's lock in whatever state it
+    # happens to be in, so start the workers from scratch instead
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker,
+                               args=(worker_index, num_workers, socket_dir),
+                               name=f'clipshare-worker-{worker_index}')
+               for worker_index in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit())
+    try:
+        # the other workers can't reach the rooms on a worker that's gone, so
+        # it's all or nothing
+        multiprocessing.connection.wait([worker.sentinel
+                                         for worker in workers])
+        logger.error('a worker exited, stopping the others')
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+def run_worker(worker_index=0, num_workers=1, socket_dir=None):
     bind_host = os.environ.get('BIND_HOST', '0.0.0.0')
     port = os.environ.get('PORT', 8000)
-    server = Server(bind_host, port, Relay())
+    metrics_port = os.environ.get('METRICS_PORT')
+    if metrics_port:
+        metrics_port = int(metrics_port) + worker_index
+    max_queued_bytes = int(os.environ.get('RELAY_MAX_QUEUED_BYTES',
+                                          DEFAULT_MAX_QUEUED_BYTES))
+    overflow_policy = OverflowPolicy(os.environ.get(
+        'RELAY_OVERFLOW_POLICY', DEFAULT_OVERFLOW_POLICY.value))
+    payload_cache.cache.max_bytes = int(os.environ.get(
+        'PAYLOAD_CACHE_MAX_BYTES', payload_cache.DEFAULT_MAX_CACHED_BYTES))
+    # 0 turns snapshots off. SNAPSHOT_DIR keeps them across restarts
+    snapshots = None
+    snapshot_max_bytes = int(os.environ.get('SNAPSHOT_MAX_BYTES',
+                                            DEFAULT_MAX_SNAPSHOT_BYTES))
+    if snapshot_max_bytes:
+        snapshots = SnapshotStore(max_bytes=snapshot_max_bytes,
+                                  directory=os.environ.get('SNAPSHOT_DIR'))
+        snapshots.load()
+
+    bus = None
+    if num_workers > 1:
+        bus = Bus(socket_dir, worker_index, num_workers)
+        asyncio.get_event_loop().run_until_complete(bus.start())
+    rooms = Rooms(functools.partial(Relay, max_queued_bytes=max_queued_bytes,
+                                    overflow_policy=overflow_policy),
+                  bus=bus, snapshots=snapshots)
+    server = Server(bind_host, port, rooms, metrics_port=metrics_port,
+                    reuse_port=num_workers > 1)
 
     server.start()
     asyncio.get_event_loop().run_forever()
+
+
+if __name__ == '__main__':
+    num_workers = os.environ.get('WORKERS', '1')
+    num_workers = (os.cpu_count() if num_workers == 'auto'
+                   else int(num_workers))
+    if num_workers > 1:
+        run_workers(num_workers)
+    else:
+        run_worker()
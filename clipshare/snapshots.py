@@ -0,0 +1,271 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import os
+import struct
+
+from asyncblink import AsyncSignal
+
+from .chunked_receiving import Rejoiner
+from .chunked_receiving import without_delta
+from .frames import FrameCodec
+from . import log
+from . import metrics
+
+
+logger = log.getLogger(__name__)
+
+
+DEFAULT_MAX_SNAPSHOT_BYTES = 100_000_000
+
+# a snapshot on disk is the room, followed by the frames, each with its length
+# in front of it
+FILE_MAGIC = b'clipshare.snapshot.v1\n'
+ROOM_LENGTH = struct.Struct('!H')
+FRAME_LENGTH = struct.Struct('!I')
+FILE_SUFFIX = '.snapshot'
+
+
+# the relay doesn't remember anything, so a device that connects only finds
+# out what's on everybody's clipboard once somebody copies again. the server
+# keeps the latest message relayed in each room around, to hand to devices as
+# they join.
+#
+# a snapshot is kept as the frames the message went over the wire as, so for
+# frames relayed between frame speaking peers, it's the very same buffers, and
+# sending it over again doesn't serialize anything. if there's a directory to
+# keep them in, snapshots are written there too, and loaded back up when the
+# server starts. with several workers, they all share the one directory
+class SnapshotStore:
+
+    def __init__(self, *, max_bytes=DEFAULT_MAX_SNAPSHOT_BYTES,
+                 directory=None):
+        self.max_bytes = max_bytes
+        self._directory = directory
+        self._codec = FrameCodec()
+        # room -> frames, least recently updated first
+        self._frames_by_room = OrderedDict()
+        self._total_bytes = 0
+        # room -> the newest message that's still coming in
+        self._pending_messages = {}
+        # one thread, so writes and deletes of the same file happen in order
+        self._disk_executor = ThreadPoolExecutor(max_workers=1)
+
+    # a new message to snapshot, once it comes in completely. it's only
+    # snapshotted if nothing newer came in in the meantime
+    async def record(self, room, message):
+        self._pending_messages[room] = message
+        too_big = False
+        try:
+            frames = await self._frames_for(message)
+        except _TooBigError:
+            frames = None
+            too_big = True
+        finally:
+            is_newest = self._pending_messages.get(room) is message
+            if is_newest:
+                del self._pending_messages[room]
+        if not is_newest:
+            return
+        if too_big:
+            # whatever was snapshotted before is out of date now
+            logger.debug('%r is too big to snapshot', message)
+            self._remove(room)
+            self._persist_removal(room)
+            return
+        if frames is None:
+            return
+        self._remove(room)
+        self._add(room, frames)
+        self._persist(room, frames)
+
+    # for when what's on the room's clipboard can't be snapshotted. whatever
+    # was snapshotted before, or is still coming in, is out of date now
+    def forget(self, room):
+        self._pending_messages.pop(room, None)
+        if room in self._frames_by_room:
+            self._remove(room)
+            self._persist_removal(room)
+
+    # a new message with the content of the room's snapshot, or None if
+    # there isn't one. decoding the frames only looks at their headers
+    def message_for(self, room):
+        frames = self._frames_by_room.get(room)
+        if not frames:
+            return None
+        rejoiner = Rejoiner()
+        message = None
+        for frame in frames:
+            message = (rejoiner.process_incoming_chunk(
+                self._codec.decode(frame)) or message)
+        return message
+
+    # raises _TooBigError as soon as it's clear the frames won't fit, rather
+    # than after collecting them all. chunks that were spilled to disk get
+    # copied into memory as they're collected
+    async def _frames_for(self, message):
+        message = await without_delta(message)
+        if message is None:
+            return None
+        if message.size > self.max_bytes:
+            raise _TooBigError
+        frames = []
+        size = 0
+        async for chunk in message.chunks:
+            frame = self._codec.encode(
+                chunk, message.metadata if chunk.is_the_first_chunk else None)
+            frame = b''.join(frame) if isinstance(frame, list) else frame
+            size += len(frame)
+            if size > self.max_bytes:
+                raise _TooBigError
+            frames.append(frame)
+        if message.is_cancelled or len(frames) != message.num_chunks:
+            return None
+        return frames
+
+    def _add(self, room, frames):
+        self._frames_by_room[room] = frames
+        self._total_bytes += sum(map(len, frames))
+        while self._total_bytes > self.max_bytes:
+            evicted_room = next(iter(self._frames_by_room))
+            self._remove(evicted_room)
+            self._persist_removal(evicted_room)
+            logger.debug('evicted the snapshot of a room, to make room')
+        metrics.snapshot_bytes.set(self._total_bytes)
+
+    def _remove(self, room):
+        frames = self._frames_by_room.pop(room, None)
+        if frames:
+            self._total_bytes -= sum(map(len, frames))
+            metrics.snapshot_bytes.set(self._total_bytes)
+
+    def _persist(self, room, frames):
+        if self._directory:
+            asyncio.get_event_loop().run_in_executor(
+                self._disk_executor, self._write_file, room, frames)
+
+    def _persist_removal(self, room):
+        if self._directory:
+            asyncio.get_event_loop().run_in_executor(
+                self._disk_executor, self._delete_file, room)
+
+    def _path_for(self, room):
+        # room names are secrets, of a sort. don't put them in file names
+        return os.path.join(
+            self._directory,
+            hashlib.sha256(room.encode()).hexdigest() + FILE_SUFFIX)
+
+    def _write_file(self, room, frames):
+        path = self._path_for(room)
+        # other workers might be writing the same snapshot
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        encoded_room = room.encode()
+        with open(temp_path, 'wb') as file:
+            file.write(FILE_MAGIC)
+            file.write(ROOM_LENGTH.pack(len(encoded_room)))
+            file.write(encoded_room)
+            for frame in frames:
+                file.write(FRAME_LENGTH.pack(len(frame)))
+                file.write(frame)
+        os.replace(temp_path, path)
+
+    def _delete_file(self, room):
+        try:
+            os.remove(self._path_for(room))
+        except FileNotFoundError:
+            pass
+
+    # loads the newest snapshots that fit. the rest get deleted, so the
+    # directory doesn't keep growing
+    def load(self):
+        if not self._directory:
+            return
+        os.makedirs(self._directory, exist_ok=True)
+        paths = [os.path.join(self._directory, name)
+                 for name in os.listdir(self._directory)
+                 if name.endswith(FILE_SUFFIX)]
+        paths.sort(key=os.path.getmtime)
+        snapshots = []
+        loaded_bytes = 0
+        for path in reversed(paths):
+            try:
+                room, frames = _read_file(path)
+            except (OSError, ValueError, struct.error) as e:
+                logger.warning('skipping unreadable snapshot %s: %r', path,
+                               e)
+                continue
+            size = sum(map(len, frames))
+            if loaded_bytes + size > self.max_bytes:
+                os.remove(path)
+                continue
+            loaded_bytes += size
+            snapshots.append((room, frames))
+        # oldest first, like they'd have been added
+        for room, frames in reversed(snapshots):
+            self._add(room, frames)
+        logger.info('loaded %d snapshots, %d bytes, from %s', len(snapshots),
+                    loaded_bytes, self._directory)
+
+
+class _TooBigError(Exception):
+    pass
+
+
+def _read_file(path):
+    with open(path, 'rb') as file:
+        data = file.read()
+    if not data.startswith(FILE_MAGIC):
+        raise ValueError('not a snapshot')
+    offset = len(FILE_MAGIC)
+    room_length, = ROOM_LENGTH.unpack_from(data, offset)
+    offset += ROOM_LENGTH.size
+    room = data[offset:offset+room_length].decode()
+    offset += room_length
+    frames = []
+    while offset < len(data):
+        frame_length, = FRAME_LENGTH.unpack_from(data, offset)
+        offset += FRAME_LENGTH.size
+        if offset + frame_length > len(data):
+            raise ValueError('truncated')
+        frames.append(data[offset:offset+frame_length])
+        offset += frame_length
+    return room, frames
+
+
+# stands in for the snapshot in a room's relay, so it sees every message
+# that's relayed there. messages meant for one device in particular never make
+# it here, because the relay only sends those towards that device. it never
+# sends anything itself
+class SnapshotNode:
+
+    def __init__(self, store, room):
+        self.new_message_signal = AsyncSignal()
+        self.origins = set()
+        self.num_messages_seen = 0
+        self._store = store
+        self._room = room
+
+    # the message comes in over however long it takes. don't hold up the
+    # relay's queue for us in the meantime.
+    #
+    # only full contents get snapshotted. a preview is followed by the full
+    # image anyway. a manifest would have whoever joins later fetch the
+    # contents from where they were copied, which might well be gone by then
+    async def accept_relayed_message(self, message):
+        self.num_messages_seen += 1
+        if message.metadata.get('preview'):
+            return
+        if message.metadata.get('manifest'):
+            self._store.forget(self._room)
+            return
+        asyncio.ensure_future(self._store.record(self._room, message))
+
+    def start_relaying_changes(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def __repr__(self):
+        return f'<{type(self).__name__}>'
@@ -0,0 +1,115 @@
+from collections import deque
+import os
+import time
+
+
+# exponentially weighted moving average of how fast we've been able to push
+# bytes out to the other side. it only knows about transfers big enough to
+# say something about throughput, rather than latency
+class ThroughputEstimator:
+
+    MIN_MEASURABLE_BYTES = 64 * 1024
+
+    def __init__(self, *, initial_bytes_per_second, smoothing=0.3):
+        self.bytes_per_second = initial_bytes_per_second
+        self._smoothing = smoothing
+
+    def record(self, num_bytes, seconds):
+        if num_bytes < self.MIN_MEASURABLE_BYTES or seconds <= 0:
+            return
+        self.bytes_per_second = (
+            self._smoothing * (num_bytes / seconds) +
+            (1 - self._smoothing) * self.bytes_per_second)
+
+    def seconds_to_send(self, num_bytes):
+        return num_bytes / self.bytes_per_second
+
+    # times a transfer, e.g.
+    #
+    #   with estimator.measure() as measurement:
+    #       for chunk in chunks:
+    #           await send(chunk)
+    #           measurement.add(len(chunk))
+    def measure(self):
+        return _Measurement([self])
+
+
+# times a transfer for several estimators at once
+def measure(*estimators):
+    return _Measurement(estimators)
+
+
+class _Measurement:
+
+    def __init__(self, estimators):
+        self._estimators = estimators
+        self._num_bytes = 0
+        self._started_at = None
+
+    def add(self, num_bytes):
+        self._num_bytes += num_bytes
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            seconds = time.perf_counter() - self._started_at
+            for estimator in self._estimators:
+                estimator.record(self._num_bytes, seconds)
+
+
+# to anywhere. a client only has the one connection to the server anyway
+outgoing = ThroughputEstimator(initial_bytes_per_second=5_000_000)
+
+
+# the chunk size to split messages into for one connection. there's a fixed
+# cost to every chunk, so on a fast link, small chunks waste time. on a slow
+# link, big chunks make progress jumpy, and a newer copy has to wait for the
+# chunk that's being sent to finish before it can go. a relay also has to get
+# a whole chunk before passing it along, so every hop adds a chunk's worth of
+# time. so a chunk should take about as long to send as the other side takes
+# to hear about it anyway, and never less than a minimum.
+#
+# the round trip time is the lowest one seen lately. round trips measured
+# while a big transfer is hogging the connection include the time spent
+# queued up behind it, which says nothing about how far away the other side is
+MIN_SPLIT_SIZE = int(os.environ.get('CLIPSHARE_MIN_SPLIT_SIZE', 16 * 1024))
+MAX_SPLIT_SIZE = int(os.environ.get('CLIPSHARE_MAX_SPLIT_SIZE',
+                                    4 * 1024 * 1024))
+MIN_SECONDS_PER_CHUNK = 0.01
+ROUND_TRIP_WINDOW = 6
+# chunks come in multiples of this
+SPLIT_SIZE_GRANULARITY = 4 * 1024
+
+
+class ChunkSizer:
+
+    # the bounds default to whatever MIN_SPLIT_SIZE and MAX_SPLIT_SIZE are
+    # when a size gets picked
+    def __init__(self, throughput_estimator, *, min_split_size=None,
+                 max_split_size=None):
+        self._throughput_estimator = throughput_estimator
+        self._min_split_size = min_split_size
+        self._max_split_size = max_split_size
+        self._round_trips = deque(maxlen=ROUND_TRIP_WINDOW)
+
+    def record_round_trip(self, seconds):
+        self._round_trips.append(seconds)
+
+    @property
+    def round_trip_seconds(self):
+        return min(self._round_trips) if self._round_trips else None
+
+    @property
+    def split_size(self):
+        seconds_per_chunk = max(self.round_trip_seconds or 0,
+                                MIN_SECONDS_PER_CHUNK)
+        split_size = (self._throughput_estimator.bytes_per_second *
+                      seconds_per_chunk)
+        split_size = int(split_size // SPLIT_SIZE_GRANULARITY *
+                         SPLIT_SIZE_GRANULARITY)
+        min_split_size = self._min_split_size or MIN_SPLIT_SIZE
+        max_split_size = self._max_split_size or MAX_SPLIT_SIZE
+        return max(min_split_size, min(split_size, max_split_size))
@@ -0,0 +1,177 @@
+import atexit
+import contextlib
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+
+
+# per-message tracing, from the copy on one machine to the clipboard being set
+# on another. every copy gets a trace id, which travels along with the message
+# in its metadata, and every stage the message goes through records a span:
+#
+#   {"trace": "...", "stage": "encode", "started_at": 1700000000.123,
+#    "seconds": 0.081, "process": "laptop:4242", ...}
+#
+# spans are appended to CLIPSHARE_TRACE_FILE, one JSON object per line. run
+# every machine with it set, and feed all the files to
+#
+#   python -m clipshare.tracing trace-a.jsonl trace-b.jsonl ...
+#
+# for a breakdown of where the time went. with it unset, nothing gets traced,
+# and recording a span is a no-op
+TRACE_FILE = os.environ.get('CLIPSHARE_TRACE_FILE')
+
+PROCESS = f'{socket.gethostname()}:{os.getpid()}'
+
+
+class _SpanWriter:
+
+    # writing happens on its own thread, so it never holds up the event loop
+    def __init__(self, path):
+        self._path = path
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write_forever,
+                                        name='clipshare-tracing', daemon=True)
+        self._thread.start()
+
+    def write(self, span):
+        self._queue.put(span)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _write_forever(self):
+        with open(self._path, 'a') as file:
+            while True:
+                span = self._queue.get()
+                if span is None:
+                    return
+                file.write(json.dumps(span) + '\n')
+                if self._queue.empty():
+                    file.flush()
+
+
+_writer = None
+if TRACE_FILE:
+    _writer = _SpanWriter(TRACE_FILE)
+    atexit.register(_writer.close)
+
+
+def new_trace_id():
+    return uuid.uuid4().hex if _writer else None
+
+
+# the trace id of a message, from its metadata
+def trace_id_of(metadata):
+    trace = metadata.get('trace')
+    return trace['id'] if trace else None
+
+
+# metadata for a message that's part of the trace. sent_at gets stamped on
+# by each node the message is sent out of, so the next one can tell how long
+# it spent in flight
+def trace_metadata(trace_id):
+    return {'trace': {'id': trace_id}} if trace_id else {}
+
+
+def stamp_sent_at(metadata):
+    if 'trace' not in metadata:
+        return metadata
+    return {**metadata, 'trace': {**metadata['trace'], 'sent_at': time.time()}}
+
+
+def sent_at(metadata):
+    trace = metadata.get('trace')
+    return trace.get('sent_at') if trace else None
+
+
+# e.g.
+#
+#   with tracing.span(trace_id, 'encode', encoder=encoder.name):
+#       ...
+@contextlib.contextmanager
+def span(trace_id, stage, **attributes):
+    if not (_writer and trace_id):
+        yield
+        return
+    started_at = time.time()
+    started_at_perf = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(trace_id, stage, started_at=started_at,
+               seconds=time.perf_counter() - started_at_perf, **attributes)
+
+
+# for stages that aren't a single block of code. started_at is a wall clock
+# time, from time.time()
+def record(trace_id, stage, *, started_at, seconds, **attributes):
+    if not (_writer and trace_id):
+        return
+    _writer.write({'trace': trace_id, 'stage': stage, 'started_at': started_at,
+                   'seconds': seconds, 'process': PROCESS, **attributes})
+
+
+# roughly the order a message goes through them in
+STAGES = ['capture', 'encode', 'serialize', 'split', 'offer', 'send',
+          'network', 'receive', 'fanout', 'reassemble', 'set', 'total']
+
+
+def _stage_order(stage):
+    return STAGES.index(stage) if stage in STAGES else len(STAGES) - 1
+
+
+def read_spans(paths):
+    for path in paths:
+        with open(path) as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+# spans of different stages can overlap. e.g. a server relays chunks along
+# while they're still coming in, so its fan-out overlaps with receiving. so
+# the stages don't add up to the total, which is from the first span of a
+# trace starting until the last one ending
+def breakdown(spans):
+    seconds_by_stage = {}
+    extent_by_trace = {}
+    for span in spans:
+        seconds_by_stage.setdefault(span['stage'], []).append(span['seconds'])
+        ended_at = span['started_at'] + span['seconds']
+        started_at, last_ended_at = extent_by_trace.get(
+            span['trace'], (span['started_at'], ended_at))
+        extent_by_trace[span['trace']] = (min(started_at, span['started_at']),
+                                          max(last_ended_at, ended_at))
+    seconds_by_stage['total'] = [ended_at - started_at for started_at, ended_at
+                                 in extent_by_trace.values()]
+    return {stage: _summarize(seconds)
+            for stage, seconds in seconds_by_stage.items()}
+
+
+def _summarize(seconds):
+    seconds = sorted(seconds)
+    return {'count': len(seconds),
+            'mean': sum(seconds) / len(seconds),
+            'p50': seconds[len(seconds) // 2],
+            'p95': seconds[min(int(len(seconds) * 0.95), len(seconds) - 1)],
+            'max': seconds[-1]}
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python -m clipshare.tracing <trace file> [<trace file> ...]
+    summary_by_stage = breakdown(read_spans(sys.argv[1:]))
+    print(f'{"stage":<12} {"count":>6} {"mean":>9} {"p50":>9} {"p95":>9} '
+          f'{"max":>9}')
+    for stage, summary in sorted(summary_by_stage.items(),
+                                 key=lambda item: _stage_order(item[0])):
+        print(f'{stage:<12} {summary["count"]:>6} '
+              + ' '.join(f'{summary[key] * 1000:>7.1f}ms'
+                         for key in ('mean', 'p50', 'p95', 'max')))
@@ -15,8 +15,16 @@ class ProgressSignaler:
         self._progress = self._progress.increment_completed
         self._signal.send(self._progress)
 
+    def cancel_transfer(self):
+        self._progress = self._progress._replace(is_cancelled=True)
+        self._signal.send(self._progress)
+
+
+class TransferProgress(namedtuple('TransferProgress',
+                                  'total completed is_cancelled')):
 
-class TransferProgress(namedtuple('TransferProgress', 'total completed')):
+    def __new__(cls, total, completed, is_cancelled=False):
+        return super().__new__(cls, total, completed, is_cancelled)
 
     @property
     def increment_completed(self):
@@ -25,3 +33,7 @@ class TransferProgress(namedtuple('TransferProgress', 'total completed')):
     @property
     def is_complete(self):
         return self.total == self.completed
+
+    @property
+    def is_over(self):
+        return self.is_complete or self.is_cancelled
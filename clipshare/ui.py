@@ -118,14 +118,18 @@ class Tray:
         self._rebuild_menu()
 
     def handle_incoming_transfer_progress(self, transfer_progress):
-        if transfer_progress.is_complete:
+        if transfer_progress.is_cancelled:
+            self.set_icon(self._icons.connected)
+        elif transfer_progress.is_complete:
             self.set_icon(self._icons.recently_received_from_remote)
             self._schedule_activity_indicator_to_go_back_to_normal()
         else:
             self.set_icon(self._icons.downloading)
 
     def handle_outgoing_transfer_progress(self, transfer_progress):
-        if transfer_progress.is_complete:
+        if transfer_progress.is_cancelled:
+            self.set_icon(self._icons.connected)
+        elif transfer_progress.is_complete:
             self.set_icon(self._icons.recently_sent_to_remote)
             self._schedule_activity_indicator_to_go_back_to_normal()
         else:
@@ -208,9 +212,9 @@ class Scheduler:
         self._task = asyncio.ensure_future(future)
 
     async def _wait_then_execute_task(self, func, timeout):
-        logger.debug(f'waiting {timeout} seconds before executing {func}')
+        logger.debug('waiting %s seconds before executing %s', timeout, func)
         await asyncio.sleep(timeout)
-        logger.debug(f'executing {func}')
+        logger.debug('executing %s', func)
         func()
 
 
@@ -245,7 +249,7 @@ class ProgressWindow:
             self._incoming_progress_dialog = self._open_dialog(
                 'Receiving from remote clipboard\u2026')
 
-        if transfer_progress.is_complete:
+        if transfer_progress.is_over:
             self._close_if_open(self._incoming_progress_dialog)
             self._incoming_progress_dialog = None
             return
@@ -257,7 +261,7 @@ class ProgressWindow:
         if not self._outgoing_progress_dialog:
             self._outgoing_progress_dialog = self._open_dialog('Sending to remote clipboard\u2026')
 
-        if transfer_progress.is_complete:
+        if transfer_progress.is_over:
             self._close_if_open(self._outgoing_progress_dialog)
             self._outgoing_progress_dialog = None
             return
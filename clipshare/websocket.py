@@ -5,6 +5,12 @@ import asyncio
 # that, if transferring images, so let's just turn the limit off
 MAX_PAYLOAD_SIZE = None
 
+# websockets turns on permessage-deflate by default, which compresses every
+# single frame. we already compress messages ourselves when it's worth it (see
+# compression.py), and compressing everything again, images included, makes
+# transfers over a fast link more than ten times slower
+COMPRESSION = None
+
 
 KEEPALIVE_INTERVAL_SECONDS = 30
 
@@ -13,7 +19,16 @@ KEEPALIVE_INTERVAL_SECONDS = 30
 # disconnected frequently. at least on dokku's settings. adding this keepalive
 # fixes the problem there. it's probably good to keep this in here. i bet it'll
 # help with other configurations as well.
+#
+# returns as soon as the connection closes, rather than at the next ping, so
+# whatever the connection was holding onto gets let go of right away
 async def keepalive_forever(websocket):
-    while True:
-        await asyncio.sleep(KEEPALIVE_INTERVAL_SECONDS)
-        await websocket.ping()
+    closed = asyncio.ensure_future(websocket.wait_closed())
+    try:
+        while True:
+            await asyncio.wait([closed], timeout=KEEPALIVE_INTERVAL_SECONDS)
+            if closed.done():
+                return
+            await websocket.ping()
+    finally:
+        closed.cancel()